@@ -1,12 +1,13 @@
 from flask import Flask, request
+import hmac
+import orjson
 import os
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'vercel-secret-key')
 
-@app.route('/')
-def index():
-    return '''
+# Static responses are rendered once per cold start, not once per request
+_INDEX_HTML = '''
     <!DOCTYPE html>
     <html>
     <head>
@@ -37,30 +38,48 @@ def index():
         </div>
     </body>
     </html>
-    '''
+    '''.encode('utf-8')
+
+_HEALTH_JSON = orjson.dumps({
+    'status': 'healthy',
+    'message': 'KAPCI WhatsApp AI Agent is running on Vercel'
+})
+
+_STATS_JSON = orjson.dumps({
+    'total_tickets': 0,
+    'pending_review': 0,
+    'completed_today': 0,
+    'message': 'Demo mode - connect a database for real data'
+})
+
+_STATIC_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+_VERIFY_TOKEN = os.getenv('WHATSAPP_VERIFY_TOKEN', 'kapci_verify_token').encode()
+
+
+@app.route('/')
+def index():
+    response = app.response_class(_INDEX_HTML, mimetype='text/html')
+    response.headers['Cache-Control'] = _STATIC_CACHE_CONTROL
+    return response
 
 @app.route('/api/health')
 def health():
-    return {'status': 'healthy', 'message': 'KAPCI WhatsApp AI Agent is running on Vercel'}
+    return app.response_class(_HEALTH_JSON, mimetype='application/json')
 
 @app.route('/api/stats')
 def stats():
-    return {
-        'total_tickets': 0,
-        'pending_review': 0,
-        'completed_today': 0,
-        'message': 'Demo mode - connect a database for real data'
-    }
+    return app.response_class(_STATS_JSON, mimetype='application/json')
 
 @app.route('/api/webhook/whatsapp', methods=['GET', 'POST'])
 def whatsapp_webhook():
     if request.method == 'GET':
-        verify_token = os.getenv('WHATSAPP_VERIFY_TOKEN', 'kapci_verify_token')
         mode = request.args.get('hub.mode')
         token = request.args.get('hub.verify_token')
         challenge = request.args.get('hub.challenge')
 
-        if mode == 'subscribe' and token == verify_token:
+        if mode == 'subscribe' and hmac.compare_digest(
+                token.encode() if token else b'', _VERIFY_TOKEN):
             return challenge, 200
         return 'Verification failed', 403
 
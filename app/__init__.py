@@ -2,10 +2,56 @@
 KAPCI WhatsApp AI Agent - Application Factory
 """
 import os
+import orjson
 from flask import Flask
+from flask.json.provider import DefaultJSONProvider
 from config.settings import config
 
 
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson; falls back to Flask's default() for
+    types orjson doesn't handle natively (Decimal, etc.)"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default,
+                            option=orjson.OPT_NAIVE_UTC).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+# Default technicians seeded into an empty database
+_DEFAULT_TECHNICIANS = (
+    {
+        'employee_id': 'TECH001',
+        'name': 'Ahmed Mohamed',
+        'email': 'ahmed@kapci.com',
+        'department': 'Technical Support',
+        'is_active': True,
+        'max_workload': 15
+    },
+    {
+        'employee_id': 'TECH002',
+        'name': 'Sara Ali',
+        'email': 'sara@kapci.com',
+        'department': 'Technical Support',
+        'is_active': True,
+        'max_workload': 15
+    },
+    {
+        'employee_id': 'TECH003',
+        'name': 'Mohamed Hassan',
+        'email': 'mohamed@kapci.com',
+        'department': 'Technical Support',
+        'is_active': True,
+        'max_workload': 15
+    },
+)
+
+# Database URIs this process has already created tables and seed data for
+_bootstrapped_uris = set()
+
+
 def create_app(config_name=None):
     """Application factory"""
     
@@ -19,51 +65,99 @@ def create_app(config_name=None):
     # Load configuration
     app.config.from_object(config[config_name])
     
+    # Serialize jsonify()/request.json with orjson
+    app.json_provider_class = OrjsonProvider
+    app.json = OrjsonProvider(app)
+    
     # Initialize extensions
     from app.models import db, init_db
     db.init_app(app)
     
-    # Initialize services
-    from app.services.whatsapp_service import whatsapp_service
-    whatsapp_service.init_app(app)
+    from app.extensions import cache
+    cache.init_app(app)
+    
+    # Webhook processing moves to Celery workers when a broker is configured
+    if app.config.get('CELERY_BROKER_URL'):
+        from app.tasks import celery_init_app
+        celery_init_app(app)
+    
+    # CRM/ERP/inventory lookups are cached in Redis when it is configured
+    if app.config.get('REDIS_URL'):
+        from app.services.external_apis import init_external_services
+        init_external_services(app)
+    
+    # Initialize services lazily, on the first request that reaches the app
+    app.before_request(_init_services_once)
     
     # Register blueprints
     from app.routes import api, web
     app.register_blueprint(api)
     app.register_blueprint(web)
     
-    # Create database tables
+    # Create database tables and default data once per database and process;
+    # in-memory databases start empty for every engine so they always are
+    bootstrapped = False
+    if not app.config.get('SKIP_DB_BOOTSTRAP'):
+        uri = app.config['SQLALCHEMY_DATABASE_URI']
+        if ':memory:' in uri or uri not in _bootstrapped_uris:
+            _bootstrap_database(app)
+            _bootstrapped_uris.add(uri)
+            bootstrapped = True
+    
+    # Open the first pooled connection now so the first request doesn't pay for it
+    if not bootstrapped and app.config.get('DB_WARMUP_ON_START'):
+        _warm_up_database(app)
+    
+    return app
+
+
+def _init_services_once():
+    """Configure the WhatsApp service from the app config on first use"""
+    from flask import current_app
+    
+    app = current_app._get_current_object()
+    if app.extensions.get('whatsapp_service_ready'):
+        return
+    
+    from app.services.whatsapp_service import whatsapp_service
+    whatsapp_service.init_app(app)
+    app.extensions['whatsapp_service_ready'] = True
+
+
+def _bootstrap_database(app):
+    """Create tables and seed default technicians and ticket counters if missing"""
+    from app.models import db, Technician, TicketCounter
+    
     with app.app_context():
         db.create_all()
         
-        # Create default data
-        from app.models import Technician
-        if not Technician.query.first():
-            tech1 = Technician(
-                employee_id='TECH001',
-                name='Ahmed Mohamed',
-                email='ahmed@kapci.com',
-                department='Technical Support',
-                is_active=True,
-                max_workload=15
-            )
-            tech2 = Technician(
-                employee_id='TECH002',
-                name='Sara Ali',
-                email='sara@kapci.com',
-                department='Technical Support',
-                is_active=True,
-                max_workload=15
-            )
-            tech3 = Technician(
-                employee_id='TECH003',
-                name='Mohamed Hassan',
-                email='mohamed@kapci.com',
-                department='Technical Support',
-                is_active=True,
-                max_workload=15
+        has_technicians = db.session.query(
+            db.session.query(Technician).exists()
+        ).scalar()
+        
+        if not has_technicians:
+            db.session.bulk_save_objects(
+                [Technician(**data) for data in _DEFAULT_TECHNICIANS]
             )
-            db.session.add_all([tech1, tech2, tech3])
             db.session.commit()
+        
+        # Seed the dashboard counters for databases created before them
+        has_counters = db.session.query(
+            db.session.query(TicketCounter).exists()
+        ).scalar()
+        
+        from app.services.ticket_service import ticket_service
+        if not has_counters:
+            ticket_service.rebuild_counters()
+        else:
+            # Counters seeded before every key got a zero row
+            ticket_service.ensure_counter_keys()
+
+
+def _warm_up_database(app):
+    """Establish a pooled database connection ahead of the first request"""
+    from sqlalchemy import text
+    from app.models import db
     
-    return app
+    with app.app_context():
+        db.session.execute(text('SELECT 1'))
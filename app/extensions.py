@@ -0,0 +1,9 @@
+"""
+KAPCI WhatsApp AI Agent - Flask Extensions
+"""
+from flask_caching import Cache
+
+cache = Cache()
+
+# Cache key of the cached /api/stats view, used for invalidation
+STATS_CACHE_KEY = 'view//api/stats'
@@ -2,19 +2,130 @@
 KAPCI WhatsApp AI Agent - Database Models
 """
 from datetime import datetime
-from enum import Enum
 from flask_sqlalchemy import SQLAlchemy
-import random
-import string
+from collections import Counter
+from sqlalchemy import event, func, inspect, insert, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.functions import FunctionElement
+from sqlalchemy.types import DateTime, Text, TypeDecorator
+import calendar
+import orjson
+import secrets
+import sqlite3
+import time
 
 db = SQLAlchemy()
 
+# Applied to every new SQLite connection: WAL lets readers run alongside the
+# webhook writer and NORMAL sync drops the extra fsync per commit
+SQLITE_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA mmap_size=268435456',
+)
+
+
+@event.listens_for(Engine, 'connect')
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Tune SQLite connections; other database drivers are left untouched"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+    
+    # pysqlite opens transactions lazily and not before SAVEPOINT, so a
+    # released savepoint would commit on its own; hand transaction control
+    # to SQLAlchemy, which emits BEGIN itself (see _begin_sqlite_transaction)
+    dbapi_connection.isolation_level = None
+
+
+@event.listens_for(Engine, 'begin')
+def _begin_sqlite_transaction(connection):
+    """Open SQLite transactions explicitly so savepoints nest inside them"""
+    if connection.dialect.name == 'sqlite':
+        connection.exec_driver_sql('BEGIN')
+
+# Year used in ticket numbers, refreshed when the cached UTC year ends
+_ticket_year = 0
+_ticket_year_ends_at = 0.0
+
+
+def _current_ticket_year() -> int:
+    """Return the current UTC year, recomputing it only at year boundaries"""
+    global _ticket_year, _ticket_year_ends_at
+    if time.time() >= _ticket_year_ends_at:
+        _ticket_year = datetime.utcnow().year
+        _ticket_year_ends_at = calendar.timegm((_ticket_year + 1, 1, 1, 0, 0, 0))
+    return _ticket_year
+
+
+# ==========================================
+# SQL EXPRESSIONS
+# ==========================================
+
+class utcnow(FunctionElement):
+    """
+    Current time as naive UTC, computed by the database
+    
+    Timestamps are compared against datetime.utcnow() in Python, so the
+    database must not stamp them in its session time zone (func.now()).
+    SQLite keeps milliseconds and PostgreSQL reads the wall clock rather
+    than the transaction start, so rows written in one commit stay ordered.
+    """
+    type = DateTime()
+    inherit_cache = True
+
+
+@compiles(utcnow)
+def _utcnow_default(element, compiler, **kw):
+    return 'CURRENT_TIMESTAMP'
+
+
+@compiles(utcnow, 'sqlite')
+def _utcnow_sqlite(element, compiler, **kw):
+    return "STRFTIME('%Y-%m-%d %H:%M:%f', 'now')"
+
+
+@compiles(utcnow, 'postgresql')
+def _utcnow_postgresql(element, compiler, **kw):
+    return "TIMEZONE('utc', CLOCK_TIMESTAMP())"
+
+
+@compiles(utcnow, 'mysql')
+def _utcnow_mysql(element, compiler, **kw):
+    # Parenthesized so it is also valid as a column DEFAULT (MySQL 8.0.13+)
+    return '(UTC_TIMESTAMP(6))'
+
+
+# ==========================================
+# COLUMN TYPES
+# ==========================================
+
+class OrjsonJSON(TypeDecorator):
+    """JSON stored as TEXT and (de)serialized with orjson"""
+    impl = Text
+    cache_ok = True
+    
+    def process_bind_param(self, value, dialect):
+        return None if value is None else orjson.dumps(value).decode()
+    
+    def process_result_value(self, value, dialect):
+        return None if value is None else orjson.loads(value)
+
 
 # ==========================================
 # ENUMS
 # ==========================================
+# Plain string constants: values are stored and compared as str, and the
+# _ALL frozenset gives O(1) validation without Enum attribute machinery
 
-class TicketStatus(str, Enum):
+class TicketStatus:
     PENDING_DATA = 'pending_data'
     PENDING_REVIEW = 'pending_review'
     UNDER_REVIEW = 'under_review'
@@ -27,20 +138,43 @@ class TicketStatus(str, Enum):
     IN_DELIVERY = 'in_delivery'
     COMPLETED = 'completed'
     CANCELLED = 'cancelled'
+    _ALL = frozenset({
+        PENDING_DATA,
+        PENDING_REVIEW,
+        UNDER_REVIEW,
+        APPROVED,
+        REJECTED,
+        PENDING_FINANCE,
+        FINANCE_APPROVED,
+        PENDING_INVENTORY,
+        INVENTORY_PREPARED,
+        IN_DELIVERY,
+        COMPLETED,
+        CANCELLED,
+    })
 
 
-class TechnicalDecision(str, Enum):
+class TechnicalDecision:
     PENDING = 'pending'
     APPROVED = 'approved'
     REJECTED = 'rejected'
+    _ALL = frozenset({
+        PENDING,
+        APPROVED,
+        REJECTED,
+    })
 
 
-class CompensationType(str, Enum):
+class CompensationType:
     REFUND = 'refund'
     REPLACEMENT = 'replacement'
+    _ALL = frozenset({
+        REFUND,
+        REPLACEMENT,
+    })
 
 
-class ConversationStep(str, Enum):
+class ConversationStep:
     IDLE = 'idle'
     GREETING = 'greeting'
     COLLECTING_NAME = 'collecting_name'
@@ -51,6 +185,18 @@ class ConversationStep(str, Enum):
     COLLECTING_PHOTOS = 'collecting_photos'
     CONFIRMING_DATA = 'confirming_data'
     AWAITING_RESPONSE = 'awaiting_response'
+    _ALL = frozenset({
+        IDLE,
+        GREETING,
+        COLLECTING_NAME,
+        COLLECTING_PRODUCT,
+        COLLECTING_PURCHASE_DATE,
+        COLLECTING_QUANTITY,
+        COLLECTING_ISSUE,
+        COLLECTING_PHOTOS,
+        CONFIRMING_DATA,
+        AWAITING_RESPONSE,
+    })
 
 
 # ==========================================
@@ -69,8 +215,8 @@ class Customer(db.Model):
     kapci_account_id = db.Column(db.String(50))
     preferred_language = db.Column(db.String(10), default='ar')  # ar, en
     
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    created_at = db.Column(db.DateTime, server_default=utcnow())
+    updated_at = db.Column(db.DateTime, server_default=utcnow(), onupdate=utcnow())
     
     # Relationships
     tickets = db.relationship('Ticket', backref='customer', lazy='dynamic')
@@ -94,7 +240,11 @@ class Customer(db.Model):
 
 
 class Ticket(db.Model):
-    """Ticket model for compensation requests"""
+    """Ticket model for compensation requests
+    
+    Free-text and photo columns are deferred in the 'details' group; queries
+    that serialize them should use undefer_group('details').
+    """
     __tablename__ = 'tickets'
     
     id = db.Column(db.Integer, primary_key=True)
@@ -108,45 +258,66 @@ class Ticket(db.Model):
     quantity = db.Column(db.Integer, default=1)
     
     # Issue Details
-    issue_description = db.Column(db.Text)
+    issue_description = db.deferred(db.Column(db.Text), group='details')
     issue_category = db.Column(db.String(50))
-    photos = db.Column(db.JSON)  # List of photo URLs/paths
+    photos = db.deferred(db.Column(OrjsonJSON), group='details')  # List of photo URLs/paths
     
-    # Status and Workflow
-    status = db.Column(db.String(30), default=TicketStatus.PENDING_DATA.value)
+    # Status and Workflow (active history so counter upkeep always sees the old value)
+    status = db.column_property(
+        db.Column(db.String(30), default=TicketStatus.PENDING_DATA), active_history=True
+    )
     priority = db.Column(db.String(10), default='normal')  # low, normal, high, urgent
     
     # Technical Review
     assigned_technician_id = db.Column(db.Integer, db.ForeignKey('technicians.id'))
-    technical_decision = db.Column(db.String(20), default=TechnicalDecision.PENDING.value)
-    technical_notes = db.Column(db.Text)
+    technical_decision = db.column_property(
+        db.Column(db.String(20), default=TechnicalDecision.PENDING), active_history=True
+    )
+    technical_notes = db.deferred(db.Column(db.Text), group='details')
     technical_review_date = db.Column(db.DateTime)
     
     # Compensation
     compensation_type = db.Column(db.String(20))
-    compensation_amount = db.Column(db.Numeric(10, 2))
+    compensation_amount_cents = db.Column(db.BigInteger)  # Stored in cents
     
     # Finance/Inventory
     sales_order_number = db.Column(db.String(50))
     replacement_tracking = db.Column(db.String(100))
     
     # Timestamps
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    created_at = db.Column(db.DateTime, server_default=utcnow())
+    updated_at = db.Column(db.DateTime, server_default=utcnow(), onupdate=utcnow())
     completed_at = db.Column(db.DateTime)
     
     # Relationships
     status_history = db.relationship('TicketStatusHistory', backref='ticket', lazy='dynamic')
     
+    __table_args__ = (
+        db.Index('ix_tickets_status_created', 'status', 'created_at'),
+        db.Index('ix_tickets_status_id', 'status', 'id'),
+        db.Index('ix_tickets_tech_status', 'assigned_technician_id', 'status'),
+        db.Index('ix_tickets_customer_created', 'customer_id', 'created_at'),
+        db.Index('ix_tickets_created', 'created_at'),
+    )
+    
     def __repr__(self):
         return f'<Ticket {self.ticket_number}>'
     
+    @hybrid_property
+    def compensation_amount(self):
+        """Compensation amount in currency units"""
+        if self.compensation_amount_cents is None:
+            return None
+        return self.compensation_amount_cents / 100
+    
+    @compensation_amount.inplace.setter
+    def _compensation_amount_setter(self, value):
+        self.compensation_amount_cents = None if value is None else round(value * 100)
+    
     @staticmethod
     def generate_ticket_number():
         """Generate unique ticket number: TKT-YYYY-XXXXX"""
-        year = datetime.now().year
-        random_part = ''.join(random.choices(string.digits, k=5))
-        return f"TKT-{year}-{random_part}"
+        return f"TKT-{_current_ticket_year()}-{secrets.randbelow(100000):05d}"
     
     def to_dict(self):
         return {
@@ -190,7 +361,7 @@ class Technician(db.Model):
     current_workload = db.Column(db.Integer, default=0)
     max_workload = db.Column(db.Integer, default=10)
     
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, server_default=utcnow())
     
     # Relationships
     tickets = db.relationship('Ticket', backref='assigned_technician', lazy='dynamic')
@@ -226,11 +397,15 @@ class Conversation(db.Model):
     media_url = db.Column(db.String(500))
     
     intent = db.Column(db.String(50))  # Detected intent
-    entities = db.Column(db.JSON)  # Extracted entities
+    entities = db.Column(OrjsonJSON)  # Extracted entities
     
     status = db.Column(db.String(20), default='sent')  # sent, delivered, read, failed
     
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, server_default=utcnow())
+    
+    __table_args__ = (
+        db.Index('ix_conv_customer_created', 'customer_id', 'created_at'),
+    )
     
     def __repr__(self):
         return f'<Conversation {self.id}>'
@@ -253,26 +428,26 @@ class ConversationState(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'), unique=True, nullable=False)
     
-    current_step = db.Column(db.String(50), default=ConversationStep.IDLE.value)
+    current_step = db.Column(db.String(50), default=ConversationStep.IDLE)
     current_ticket_id = db.Column(db.Integer, db.ForeignKey('tickets.id'))
-    collected_data = db.Column(db.JSON, default=dict)
-    context = db.Column(db.JSON, default=dict)  # Additional context
+    collected_data = db.Column(OrjsonJSON, default=dict)
+    context = db.Column(OrjsonJSON, default=dict)  # Additional context
     
-    last_message_at = db.Column(db.DateTime, default=datetime.utcnow)
-    session_start = db.Column(db.DateTime, default=datetime.utcnow)
+    last_message_at = db.Column(db.DateTime, server_default=utcnow())
+    session_start = db.Column(db.DateTime, server_default=utcnow())
     
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, server_default=utcnow(), onupdate=utcnow())
     
     def __repr__(self):
         return f'<ConversationState customer={self.customer_id} step={self.current_step}>'
     
     def reset(self):
         """Reset conversation state"""
-        self.current_step = ConversationStep.IDLE.value
+        self.current_step = ConversationStep.IDLE
         self.current_ticket_id = None
         self.collected_data = {}
         self.context = {}
-        self.session_start = datetime.utcnow()
+        self.session_start = utcnow()
 
 
 class TicketStatusHistory(db.Model):
@@ -287,12 +462,96 @@ class TicketStatusHistory(db.Model):
     changed_by = db.Column(db.String(100))  # User/System who made the change
     reason = db.Column(db.Text)
     
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, server_default=utcnow())
     
     def __repr__(self):
         return f'<TicketStatusHistory {self.ticket_id}: {self.old_status} -> {self.new_status}>'
 
 
+class TicketCounter(db.Model):
+    """
+    Running ticket counts for the dashboard, keyed by counter_key()
+    
+    Kept in step with the tickets table by the before_flush hook below, so
+    statistics are read from a handful of rows instead of scanning tickets.
+    """
+    __tablename__ = 'ticket_counters'
+    
+    key = db.Column(db.String(50), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    
+    TOTAL = 'total'
+    
+    @staticmethod
+    def counter_key(kind: str, value: str) -> str:
+        """Key for a status ('status') or technical decision ('decision') count"""
+        return f'{kind}:{value}'
+    
+    @classmethod
+    def all_keys(cls) -> list:
+        """Every counter key a valid ticket can touch, for seeding zero rows"""
+        return [cls.TOTAL] + [
+            cls.counter_key(kind, value)
+            for kind, values in (('status', TicketStatus._ALL), ('decision', TechnicalDecision._ALL))
+            for value in sorted(values)
+        ]
+    
+    def __repr__(self):
+        return f'<TicketCounter {self.key}={self.count}>'
+
+
+# Ticket attributes that have per-value counters, with their key prefix
+_COUNTED_TICKET_FIELDS = (('status', 'status'), ('technical_decision', 'decision'))
+
+
+def _ticket_counter_values(ticket) -> list:
+    """Counter keys a ticket contributes to, applying column defaults to unset fields"""
+    keys = [TicketCounter.TOTAL]
+    for attr, kind in _COUNTED_TICKET_FIELDS:
+        value = getattr(ticket, attr)
+        if value is None:
+            value = Ticket.__table__.c[attr].default.arg
+        keys.append(TicketCounter.counter_key(kind, value))
+    return keys
+
+
+@event.listens_for(Session, 'before_flush')
+def _update_ticket_counters(session, flush_context, instances):
+    """Apply ticket inserts, deletes and status/decision changes to ticket_counters"""
+    deltas = Counter()
+    for ticket in session.new:
+        if isinstance(ticket, Ticket):
+            deltas.update(_ticket_counter_values(ticket))
+    for ticket in session.deleted:
+        if isinstance(ticket, Ticket):
+            deltas.subtract(_ticket_counter_values(ticket))
+    for ticket in session.dirty:
+        if not isinstance(ticket, Ticket):
+            continue
+        attrs = inspect(ticket).attrs
+        for attr, kind in _COUNTED_TICKET_FIELDS:
+            history = attrs[attr].history
+            if not history.has_changes():
+                continue
+            deltas.subtract(TicketCounter.counter_key(kind, v) for v in history.deleted if v is not None)
+            deltas.update(TicketCounter.counter_key(kind, v) for v in history.added if v is not None)
+    
+    # Every known key is seeded with a zero row (see rebuild_counters and
+    # ensure_counter_keys), so this is a plain UPDATE; the INSERT fallback
+    # only covers values outside the status/decision constants
+    table = TicketCounter.__table__
+    connection = None
+    for key, delta in deltas.items():
+        if not delta:
+            continue
+        connection = connection or session.connection()
+        result = connection.execute(
+            update(table).where(table.c.key == key).values(count=table.c.count + delta)
+        )
+        if not result.rowcount:
+            connection.execute(insert(table).values(key=key, count=delta))
+
+
 class Notification(db.Model):
     """Notification tracking"""
     __tablename__ = 'notifications'
@@ -309,7 +568,7 @@ class Notification(db.Model):
     sent_at = db.Column(db.DateTime)
     delivered_at = db.Column(db.DateTime)
     
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, server_default=utcnow())
     
     def __repr__(self):
         return f'<Notification {self.id}>'
@@ -330,7 +589,7 @@ class AdminUser(db.Model):
     is_active = db.Column(db.Boolean, default=True)
     last_login = db.Column(db.DateTime)
     
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, server_default=utcnow())
     
     def __repr__(self):
         return f'<AdminUser {self.username}>'
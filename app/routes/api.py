@@ -1,12 +1,50 @@
 """
 KAPCI WhatsApp AI Agent - API Routes
 """
-from flask import Blueprint, request, jsonify, current_app
-from app.models import db, Ticket, Customer, Technician, Conversation
-from app.services import workflow_service, ticket_service, whatsapp_service
+import hashlib
+import orjson
+from concurrent.futures import ThreadPoolExecutor
+from flask import Blueprint, Response, request, jsonify, current_app, g, stream_with_context
+from sqlalchemy import func, select
+from app.extensions import cache
+from app.models import db, Ticket, Customer, Technician, Conversation, TicketStatusHistory
 
 api = Blueprint('api', __name__, url_prefix='/api')
 
+# Rows fetched per round-trip when streaming ticket lists
+TICKET_STREAM_BATCH = 100
+
+# Webhook messages processed in-process when no Celery broker is configured;
+# the bounded pool queues bursts instead of spawning a thread per message
+INBOUND_WORKERS = 8
+_inbound_executor = ThreadPoolExecutor(max_workers=INBOUND_WORKERS, thread_name_prefix='inbound')
+
+
+def _json(payload, status=200):
+    """Serialize payload with orjson into a JSON response"""
+    return Response(orjson.dumps(payload), status=status, mimetype='application/json')
+
+
+def _etag(*parts):
+    """Build a short ETag from the values that identify a resource version"""
+    key = ':'.join(str(p) for p in parts).encode()
+    return hashlib.blake2b(key, digest_size=8).hexdigest()
+
+
+def _customer_by_phone(phone):
+    """Get customer by phone number, memoized for the current request"""
+    customers = g.setdefault('customers_by_phone', {})
+    if phone not in customers:
+        customers[phone] = Customer.query.filter_by(phone_number=phone).first()
+    return customers[phone]
+
+
+def _not_modified(etag):
+    """Empty 304 response for a conditional GET that matched"""
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
 
 # ==========================================
 # WHATSAPP WEBHOOK ROUTES
@@ -15,6 +53,8 @@ api = Blueprint('api', __name__, url_prefix='/api')
 @api.route('/webhook/whatsapp', methods=['GET'])
 def verify_webhook():
     """Verify WhatsApp webhook subscription"""
+    from app.services.whatsapp_service import whatsapp_service
+    
     mode = request.args.get('hub.mode')
     token = request.args.get('hub.verify_token')
     challenge = request.args.get('hub.challenge')
@@ -29,6 +69,13 @@ def verify_webhook():
 @api.route('/webhook/whatsapp', methods=['POST'])
 def receive_message():
     """Receive incoming WhatsApp message"""
+    from app.services.whatsapp_service import whatsapp_service
+    
+    # Reject forged deliveries before parsing anything
+    if not whatsapp_service.verify_signature(request.get_data(),
+                                             request.headers.get('X-Hub-Signature-256')):
+        return 'Forbidden', 403
+    
     payload = request.json
     
     # Parse incoming message
@@ -37,28 +84,25 @@ def receive_message():
     if not parsed:
         return jsonify({'status': 'no_message'}), 200
     
-    # Process message
-    try:
-        response = workflow_service.handle_incoming_message(
-            phone=parsed['from'],
-            message=parsed.get('content', ''),
-            message_type=parsed.get('type', 'text'),
-            media_id=parsed.get('media_id'),
-            contact_name=parsed.get('contact_name')
-        )
-        
-        # Send response via WhatsApp
-        whatsapp_service.send_text_message(parsed['from'], response)
-        
-        # Mark as read
-        if parsed.get('message_id'):
-            whatsapp_service.mark_as_read(parsed['message_id'])
-        
-        return jsonify({'status': 'processed'}), 200
-        
-    except Exception as e:
-        current_app.logger.error(f"Error processing message: {e}")
-        return jsonify({'status': 'error', 'message': str(e)}), 500
+    # Acknowledge immediately; Meta retries webhooks that respond slowly
+    if 'celery' in current_app.extensions:
+        from app.tasks import process_incoming
+        process_incoming.delay(parsed)
+    else:
+        _inbound_executor.submit(_process_message, current_app._get_current_object(), parsed)
+    
+    return jsonify({'status': 'queued'}), 200
+
+
+def _process_message(app, parsed):
+    """Run the workflow for a parsed message in an executor thread"""
+    from app.services.workflow_service import workflow_service
+    
+    with app.app_context():
+        try:
+            workflow_service.process_incoming(parsed)
+        except Exception as e:
+            app.logger.error(f"Error processing message: {e}")
 
 
 # ==========================================
@@ -68,6 +112,8 @@ def receive_message():
 @api.route('/chat', methods=['POST'])
 def chat():
     """Demo chat endpoint"""
+    from app.services.workflow_service import workflow_service
+    
     data = request.json
     phone = data.get('phone', '+20100000000')
     message = data.get('message', '')
@@ -89,17 +135,31 @@ def chat():
 @api.route('/messages/<phone>', methods=['GET'])
 def get_messages(phone):
     """Get chat history for a phone number"""
-    customer = Customer.query.filter_by(phone_number=phone).first()
+    customer = _customer_by_phone(phone)
     
     if not customer:
         return jsonify({'messages': []})
     
-    messages = Conversation.query.filter_by(customer_id=customer.id)\
-        .order_by(Conversation.created_at.asc()).all()
+    # Polls are answered with 304 until a message is added
+    latest, count = db.session.execute(
+        select(func.max(Conversation.created_at), func.count())
+        .where(Conversation.customer_id == customer.id)
+    ).one()
+    etag = _etag(customer.id, latest, count)
+    if request.if_none_match.contains(etag):
+        return _not_modified(etag)
+    
+    messages = db.session.scalars(
+        select(Conversation)
+        .where(Conversation.customer_id == customer.id)
+        .order_by(Conversation.created_at.asc(), Conversation.id.asc())
+    )
     
-    return jsonify({
+    response = _json({
         'messages': [m.to_dict() for m in messages]
     })
+    response.set_etag(etag)
+    return response
 
 
 # ==========================================
@@ -109,29 +169,50 @@ def get_messages(phone):
 @api.route('/tickets', methods=['GET'])
 def get_tickets():
     """Get all tickets with optional filters"""
+    from app.services.ticket_service import ticket_service
+    
     status = request.args.get('status')
     limit = request.args.get('limit', 50, type=int)
     
-    query = Ticket.query
-    
-    if status:
-        query = query.filter_by(status=status)
+    stmt = ticket_service.select_ticket_rows(status=status, limit=limit)
     
-    tickets = query.order_by(Ticket.created_at.desc()).limit(limit).all()
+    # Stream rows as they are loaded so large limits use constant memory
+    def generate():
+        yield b'{"tickets":['
+        prefix = b''
+        rows = db.session.execute(stmt.execution_options(yield_per=TICKET_STREAM_BATCH)).mappings()
+        for row in rows:
+            yield prefix + orjson.dumps(dict(row))
+            prefix = b','
+        yield b']}'
     
-    return jsonify({
-        'tickets': [t.to_dict() for t in tickets]
-    })
+    return Response(stream_with_context(generate()), mimetype='application/json')
 
 
 @api.route('/tickets/<int:ticket_id>', methods=['GET'])
 def get_ticket(ticket_id):
     """Get single ticket details"""
-    ticket = ticket_service.get_ticket(ticket_id)
-    
-    if not ticket:
+    from app.services.ticket_service import ticket_service
+    
+    # Polls are answered with 304 until the ticket or its history changes
+    version = db.session.execute(
+        select(
+            Ticket.updated_at,
+            select(func.count())
+            .where(TicketStatusHistory.ticket_id == ticket_id)
+            .scalar_subquery()
+        ).where(Ticket.id == ticket_id)
+    ).first()
+    
+    if version is None:
         return jsonify({'error': 'Ticket not found'}), 404
     
+    etag = _etag(ticket_id, *version)
+    if request.if_none_match.contains(etag):
+        return _not_modified(etag)
+    
+    ticket = ticket_service.get_ticket(ticket_id)
+    
     # Include status history
     history = ticket_service.get_status_history(ticket_id)
     
@@ -146,12 +227,17 @@ def get_ticket(ticket_id):
         } for h in history
     ]
     
-    return jsonify(result)
+    response = jsonify(result)
+    response.set_etag(etag)
+    return response
 
 
 @api.route('/tickets/<int:ticket_id>/decision', methods=['POST'])
 def make_decision(ticket_id):
     """Technical team makes decision on ticket"""
+    from app.services.workflow_service import workflow_service
+    from app.services.ticket_service import ticket_service
+    
     data = request.json
     decision = data.get('decision')  # 'approved' or 'rejected'
     reason = data.get('reason', '')
@@ -182,6 +268,8 @@ def make_decision(ticket_id):
 @api.route('/tickets/<int:ticket_id>/complete', methods=['POST'])
 def complete_ticket(ticket_id):
     """Mark ticket as completed"""
+    from app.services.ticket_service import ticket_service
+    
     data = request.json or {}
     completed_by = data.get('completed_by', 'System')
     
@@ -199,6 +287,8 @@ def complete_ticket(ticket_id):
 @api.route('/tickets/<int:ticket_id>/assign', methods=['POST'])
 def assign_ticket(ticket_id):
     """Assign ticket to technician"""
+    from app.services.ticket_service import ticket_service
+    
     data = request.json or {}
     technician_id = data.get('technician_id')
     
@@ -218,11 +308,14 @@ def assign_ticket(ticket_id):
 # ==========================================
 
 @api.route('/technicians', methods=['GET'])
+@cache.cached(timeout=60)
 def get_technicians():
     """Get all technicians"""
-    technicians = Technician.query.filter_by(is_active=True).all()
+    technicians = db.session.scalars(
+        select(Technician).where(Technician.is_active.is_(True))
+    )
     
-    return jsonify({
+    return _json({
         'technicians': [t.to_dict() for t in technicians]
     })
 
@@ -230,6 +323,8 @@ def get_technicians():
 @api.route('/technicians/<int:tech_id>/tickets', methods=['GET'])
 def get_technician_tickets(tech_id):
     """Get tickets assigned to a technician"""
+    from app.services.ticket_service import ticket_service
+    
     tickets = ticket_service.get_technician_tickets(tech_id)
     
     return jsonify({
@@ -242,17 +337,24 @@ def get_technician_tickets(tech_id):
 # ==========================================
 
 @api.route('/stats', methods=['GET'])
+@cache.cached(timeout=10)
 def get_stats():
     """Get dashboard statistics"""
+    from app.services.ticket_service import ticket_service
+    
     stats = ticket_service.get_statistics()
     return jsonify(stats)
 
 
 @api.route('/stats/overdue', methods=['GET'])
+@cache.cached(timeout=30, query_string=True)
 def get_overdue():
     """Get overdue tickets"""
+    from app.services.ticket_service import ticket_service
+    
     days = request.args.get('days', 2, type=int)
-    tickets = ticket_service.get_overdue_tickets(days)
+    limit = request.args.get('limit', type=int)
+    tickets = ticket_service.get_overdue_tickets(days, limit)
     
     return jsonify({
         'count': len(tickets),
@@ -267,25 +369,27 @@ def get_overdue():
 @api.route('/customers/<phone>', methods=['GET'])
 def get_customer(phone):
     """Get customer by phone number"""
-    customer = Customer.query.filter_by(phone_number=phone).first()
+    customer = _customer_by_phone(phone)
     
     if not customer:
         return jsonify({'error': 'Customer not found'}), 404
     
-    return jsonify(customer.to_dict())
+    return _json(customer.to_dict())
 
 
 @api.route('/customers/<phone>/tickets', methods=['GET'])
 def get_customer_tickets(phone):
     """Get tickets for a customer"""
-    customer = Customer.query.filter_by(phone_number=phone).first()
+    from app.services.ticket_service import ticket_service
+    
+    # Customer comes back with its tickets; look it up only when there are none
+    tickets = ticket_service.get_customer_tickets_by_phone(phone)
+    customer = tickets[0].customer if tickets else _customer_by_phone(phone)
     
     if not customer:
         return jsonify({'error': 'Customer not found'}), 404
     
-    tickets = ticket_service.get_customer_tickets(customer.id)
-    
-    return jsonify({
+    return _json({
         'customer': customer.to_dict(),
         'tickets': [t.to_dict() for t in tickets]
     })
@@ -3,8 +3,68 @@ KAPCI WhatsApp AI Agent - AI Service
 Intent Classification, Entity Extraction, Response Generation
 """
 import re
+import unicodedata
 from datetime import datetime
-from typing import Dict, List, Optional, Tuple
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+# Distinct (message, step) analyses kept; short replies ('yes', 'نعم', 'skip')
+# repeat across customers all day
+ANALYZE_CACHE_SIZE = 4096
+
+# Longer messages are free-form descriptions that practically never repeat
+ANALYZE_CACHE_MAX_LENGTH = 200
+
+# Tatweel (kashida) and Arabic diacritics carry no meaning for matching
+_ARABIC_MARKS = dict.fromkeys([0x0640, *range(0x064B, 0x0660), 0x0670])
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize text for keyword matching
+    
+    Applies NFKC (folds Arabic presentation forms), casefolds and drops
+    tatweel and diacritics.
+    """
+    return unicodedata.normalize('NFKC', text).casefold().translate(_ARABIC_MARKS)
+
+
+def _keyword_pattern(keywords: Tuple[str, ...]) -> re.Pattern:
+    """Compile a keyword list into a single substring alternation"""
+    # Normalized once here, deduplicated, and longest first so overlapping
+    # keywords resolve the same way every time
+    ordered = sorted({normalize_text(k) for k in keywords}, key=len, reverse=True)
+    return re.compile('|'.join(map(re.escape, ordered)))
+
+
+def _matchers(patterns: Dict[str, re.Pattern]) -> Tuple[Tuple[str, Callable], ...]:
+    """Freeze patterns into an ordered tuple of (name, bound search) pairs"""
+    return tuple((name, pattern.search) for name, pattern in patterns.items())
+
+
+def _first_matching(matchers: Tuple[Tuple[str, Callable], ...], text: str) -> Optional[str]:
+    """Return the first name whose pattern occurs in text"""
+    for name, search in matchers:
+        if search(text):
+            return name
+    return None
+
+
+def _exact_intents(matchers: Tuple[Tuple[str, Callable], ...],
+                   keywords: Dict[str, Tuple[str, ...]]) -> Dict[str, str]:
+    """
+    Precompute the idle-state intent for messages that are exactly a keyword
+    
+    Each keyword is classified with the full pattern scan, so the table
+    always agrees with it (e.g. 'none' stays new_complaint via 'one').
+    """
+    normalized = {
+        normalize_text(keyword)
+        for intent_keywords in keywords.values()
+        for keyword in intent_keywords
+    }
+    return {keyword: _first_matching(matchers, keyword) for keyword in normalized}
 
 
 class AIService:
@@ -12,65 +72,154 @@ class AIService:
     
     # Intent keywords (Arabic + English)
     INTENT_KEYWORDS = {
-        'greeting': [
+        'greeting': (
             'hello', 'hi', 'hey', 'good morning', 'good evening',
             'السلام عليكم', 'مرحبا', 'اهلا', 'صباح الخير', 'مساء الخير', 'هلا'
-        ],
-        'new_complaint': [
+        ),
+        'new_complaint': (
             'complaint', 'problem', 'issue', 'defect', 'broken', 'damaged', 'wrong',
             'شكوى', 'مشكلة', 'عطل', 'خراب', 'تالف', 'معيب', 'غلط', 'مش شغال',
             '1', 'one', 'واحد'
-        ],
-        'check_status': [
+        ),
+        'check_status': (
             'status', 'track', 'follow up', 'where', 'check',
             'متابعة', 'حالة', 'تتبع', 'فين', 'وصلت فين',
             '2', 'two', 'اتنين'
-        ],
-        'provide_info': [
+        ),
+        'provide_info': (
             # This is detected by context, not keywords
-        ],
-        'send_photo': [
+        ),
+        'send_photo': (
             'photo', 'image', 'picture', 'attached',
             'صورة', 'صور'
-        ],
-        'confirm_yes': [
+        ),
+        'confirm_yes': (
             'yes', 'yeah', 'yep', 'ok', 'okay', 'correct', 'right', 'confirm', 'sure',
             'نعم', 'اه', 'ايه', 'ايوه', 'صح', 'تمام', 'موافق', 'اكيد', 'ماشي'
-        ],
-        'confirm_no': [
+        ),
+        'confirm_no': (
             'no', 'nope', 'wrong', 'incorrect', 'change', 'edit',
             'لا', 'لأ', 'غلط', 'مش صح', 'تعديل', 'غير'
-        ],
-        'skip': [
+        ),
+        'skip': (
             'skip', 'no photo', 'no photos', 'none', 'nothing', 'done',
             'تخطي', 'مفيش', 'تم', 'بدون', 'لا صور', 'مش هبعت'
-        ],
-        'cancel': [
+        ),
+        'cancel': (
             'cancel', 'stop', 'quit', 'exit', 'bye',
             'الغاء', 'الغي', 'وقف', 'خلاص', 'مع السلامة'
-        ],
-        'help': [
+        ),
+        'help': (
             'help', 'assist', 'support', 'how',
             'مساعدة', 'ساعدني', 'ازاي', 'كيف'
-        ],
-        'thanks': [
+        ),
+        'thanks': (
             'thanks', 'thank you', 'thx',
             'شكرا', 'متشكر'
-        ]
+        )
     }
     
+    # One compiled alternation per intent, in INTENT_KEYWORDS priority order.
+    # Intents without keywords (provide_info) are context-only and skipped.
+    INTENT_PATTERNS = {
+        intent: _keyword_pattern(keywords)
+        for intent, keywords in INTENT_KEYWORDS.items() if keywords
+    }
+    
+    # Priority-ordered (intent, search) pairs: no dict iteration per message
+    INTENT_MATCHERS = _matchers(INTENT_PATTERNS)
+    
+    # Whole-message lookup for the common one-word openers ('1', 'hi', 'مرحبا')
+    INTENT_BY_MESSAGE = _exact_intents(INTENT_MATCHERS, INTENT_KEYWORDS)
+    
     # Entity patterns
+    # Email quantifiers are bounded and numbers are digit-delimited so adversarial
+    # input cannot trigger heavy backtracking
     ENTITY_PATTERNS = {
-        'ticket_number': r'TKT-\d{4}-\d{5}',
-        'phone': r'(?:\+?20)?(?:0)?1[0125]\d{8}',
+        'ticket_number': r'\bTKT-\d{4}-\d{5}\b',
+        'phone': r'(?<!\d)(?:\+?20)?0?1[0125]\d{8}(?!\d)',
         'date': r'\d{1,2}[-/]\d{1,2}[-/]\d{2,4}',
         'quantity': r'(?:quantity|qty|كمية|عدد)[:\s]*(\d+)',
-        'email': r'[\w\.-]+@[\w\.-]+\.\w+'
+        'email': r'[\w.+-]{1,64}@[\w.-]{1,253}\.[A-Za-z]{2,24}'
+    }
+    
+    # One compiled search per entity, so entities that overlap in the text
+    # (a phone inside an email) are each still found. Only quantity is
+    # case-insensitive.
+    ENTITY_MATCHERS = tuple(
+        (name, re.compile(pattern, re.IGNORECASE if name == 'quantity' else 0).search)
+        for name, pattern in ENTITY_PATTERNS.items()
+    )
+    
+    # Runs of Arabic / Latin letters, used to weigh the script of a message
+    ARABIC_RUN_RE = re.compile(r'[\u0600-\u06FF]+')
+    LATIN_RUN_RE = re.compile(r'[a-zA-Z]+')
+    
+    # Sentiment vocabularies (single words, matched against message tokens)
+    NEGATIVE_WORDS = frozenset(map(normalize_text, (
+        'bad', 'terrible', 'awful', 'horrible', 'worst', 'angry', 'frustrated',
+        'سيء', 'وحش', 'زعلان', 'متضايق', 'غضبان'
+    )))
+    
+    POSITIVE_WORDS = frozenset(map(normalize_text, (
+        'good', 'great', 'excellent', 'thanks', 'happy', 'satisfied',
+        'كويس', 'ممتاز', 'شكرا', 'مبسوط', 'راضي'
+    )))
+    
+    WORD_RE = re.compile(r'\w+')
+    
+    # Issue category keywords, checked in priority order
+    ISSUE_CATEGORIES = {
+        'quality': ('quality', 'defect', 'broken', 'damaged', 'جودة', 'معيب', 'مكسور'),
+        'wrong_product': ('wrong', 'different', 'not what', 'غلط', 'مختلف'),
+        'missing_parts': ('missing', 'incomplete', 'ناقص', 'مش كامل'),
+        'not_working': ('not working', 'doesnt work', 'مش شغال', 'مش بيشتغل'),
+        'expired': ('expired', 'old', 'منتهي', 'قديم'),
+        'packaging': ('packaging', 'box', 'تغليف', 'علبة')
+    }
+    
+    ISSUE_CATEGORY_PATTERNS = {
+        category: _keyword_pattern(keywords)
+        for category, keywords in ISSUE_CATEGORIES.items()
     }
     
+    ISSUE_CATEGORY_MATCHERS = _matchers(ISSUE_CATEGORY_PATTERNS)
+    
     def __init__(self, llm_provider=None):
         """Initialize AI Service"""
         self.llm_provider = llm_provider
+        # Per instance, so services with different providers never share results
+        self._analyze_cached = lru_cache(maxsize=ANALYZE_CACHE_SIZE)(self._analyze)
+    
+    def analyze(self, message: str, current_step: str = 'idle') -> Dict[str, any]:
+        """
+        Run every per-message analysis in one call
+        
+        Callers that need language, intent and entities together go through
+        here, so a model-backed provider can answer all three in a single
+        round trip instead of three.
+        
+        Args:
+            message: User message text
+            current_step: Current conversation state
+            
+        Returns:
+            Dict with 'language', 'intent' and 'entities'
+        """
+        if len(message) > ANALYZE_CACHE_MAX_LENGTH:
+            return self._analyze(message, current_step)
+        
+        # Copy so callers can't change what later lookups get back
+        result = self._analyze_cached(message, current_step)
+        return {**result, 'entities': dict(result['entities'])}
+    
+    def _analyze(self, message: str, current_step: str) -> Dict[str, any]:
+        """Uncached analysis behind analyze()"""
+        return {
+            'language': self.detect_language(message),
+            'intent': self.classify_intent(message, current_step),
+            'entities': self.extract_entities(message)
+        }
     
     def classify_intent(self, message: str, current_step: str = 'idle') -> str:
         """
@@ -83,7 +232,7 @@ class AIService:
         Returns:
             Detected intent string
         """
-        message_lower = message.lower().strip()
+        message_lower = normalize_text(message).strip()
         
         # Context-based classification for data collection steps
         if current_step in ['collecting_product', 'collecting_issue', 'collecting_name', 
@@ -93,29 +242,25 @@ class AIService:
         # Photo collection step
         if current_step == 'collecting_photos':
             # Check for skip intent
-            for keyword in self.INTENT_KEYWORDS['skip']:
-                if keyword in message_lower:
-                    return 'skip'
+            if self.INTENT_PATTERNS['skip'].search(message_lower):
+                return 'skip'
             # Check if it's a media message (would be handled by message type)
             return 'provide_info'
         
         # Confirmation step
         if current_step == 'confirming_data':
-            for keyword in self.INTENT_KEYWORDS['confirm_yes']:
-                if keyword in message_lower:
-                    return 'confirm_yes'
-            for keyword in self.INTENT_KEYWORDS['confirm_no']:
-                if keyword in message_lower:
-                    return 'confirm_no'
+            if self.INTENT_PATTERNS['confirm_yes'].search(message_lower):
+                return 'confirm_yes'
+            if self.INTENT_PATTERNS['confirm_no'].search(message_lower):
+                return 'confirm_no'
             return 'unknown'
         
         # General intent classification
-        for intent, keywords in self.INTENT_KEYWORDS.items():
-            for keyword in keywords:
-                if keyword in message_lower:
-                    return intent
+        intent = self.INTENT_BY_MESSAGE.get(message_lower)
+        if intent is None:
+            intent = _first_matching(self.INTENT_MATCHERS, message_lower)
         
-        return 'unknown'
+        return intent or 'unknown'
     
     def extract_entities(self, message: str) -> Dict[str, any]:
         """
@@ -129,30 +274,11 @@ class AIService:
         """
         entities = {}
         
-        # Ticket number
-        ticket_match = re.search(self.ENTITY_PATTERNS['ticket_number'], message)
-        if ticket_match:
-            entities['ticket_number'] = ticket_match.group()
-        
-        # Phone number
-        phone_match = re.search(self.ENTITY_PATTERNS['phone'], message)
-        if phone_match:
-            entities['phone'] = phone_match.group()
-        
-        # Date
-        date_match = re.search(self.ENTITY_PATTERNS['date'], message)
-        if date_match:
-            entities['date'] = date_match.group()
-        
-        # Quantity
-        qty_match = re.search(self.ENTITY_PATTERNS['quantity'], message, re.IGNORECASE)
-        if qty_match:
-            entities['quantity'] = int(qty_match.group(1))
-        
-        # Email
-        email_match = re.search(self.ENTITY_PATTERNS['email'], message)
-        if email_match:
-            entities['email'] = email_match.group()
+        for name, search in self.ENTITY_MATCHERS:
+            match = search(message)
+            if match:
+                # Quantity keeps only its digits
+                entities[name] = int(match.group(1)) if name == 'quantity' else match.group()
         
         return entities
     
@@ -166,9 +292,9 @@ class AIService:
         Returns:
             Language code ('ar' or 'en')
         """
-        # Arabic Unicode range
-        arabic_chars = len(re.findall(r'[\u0600-\u06FF]', message))
-        english_chars = len(re.findall(r'[a-zA-Z]', message))
+        # Count characters per word-sized run rather than one match per character
+        arabic_chars = sum(map(len, self.ARABIC_RUN_RE.findall(message)))
+        english_chars = sum(map(len, self.LATIN_RUN_RE.findall(message)))
         
         if arabic_chars > english_chars:
             return 'ar'
@@ -184,20 +310,12 @@ class AIService:
         Returns:
             Sentiment ('positive', 'negative', 'neutral')
         """
-        message_lower = message.lower()
-        
-        negative_words = [
-            'bad', 'terrible', 'awful', 'horrible', 'worst', 'angry', 'frustrated',
-            'سيء', 'وحش', 'زعلان', 'متضايق', 'غضبان'
-        ]
+        message_lower = normalize_text(message)
         
-        positive_words = [
-            'good', 'great', 'excellent', 'thanks', 'happy', 'satisfied',
-            'كويس', 'ممتاز', 'شكرا', 'مبسوط', 'راضي'
-        ]
-        
-        neg_count = sum(1 for word in negative_words if word in message_lower)
-        pos_count = sum(1 for word in positive_words if word in message_lower)
+        # Distinct vocabulary words present, as whole tokens
+        tokens = frozenset(self.WORD_RE.findall(message_lower))
+        neg_count = len(tokens & self.NEGATIVE_WORDS)
+        pos_count = len(tokens & self.POSITIVE_WORDS)
         
         if neg_count > pos_count:
             return 'negative'
@@ -215,23 +333,9 @@ class AIService:
         Returns:
             Suggested category
         """
-        desc_lower = description.lower()
-        
-        categories = {
-            'quality': ['quality', 'defect', 'broken', 'damaged', 'جودة', 'معيب', 'مكسور'],
-            'wrong_product': ['wrong', 'different', 'not what', 'غلط', 'مختلف'],
-            'missing_parts': ['missing', 'incomplete', 'ناقص', 'مش كامل'],
-            'not_working': ['not working', 'doesnt work', 'مش شغال', 'مش بيشتغل'],
-            'expired': ['expired', 'old', 'منتهي', 'قديم'],
-            'packaging': ['packaging', 'box', 'تغليف', 'علبة']
-        }
-        
-        for category, keywords in categories.items():
-            for keyword in keywords:
-                if keyword in desc_lower:
-                    return category
+        desc_lower = normalize_text(description)
         
-        return 'other'
+        return _first_matching(self.ISSUE_CATEGORY_MATCHERS, desc_lower) or 'other'
 
 
 # Singleton instance
@@ -2,13 +2,191 @@
 KAPCI WhatsApp AI Agent - External API Services
 CRM, ERP, and Inventory System Integration
 """
+import orjson
 import requests
+from functools import lru_cache
+from flask import current_app, has_app_context
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+from urllib3.util.retry import Retry
 from typing import Dict, Optional, List
 from datetime import datetime
 import logging
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
+# Connection pool sizing for each backend session
+POOL_CONNECTIONS = 32
+POOL_MAXSIZE = 64
+
+# Headers shared by every backend session. Accept-Encoding lists only the
+# codecs urllib3 can decode here (gzip/deflate, plus br/zstd when installed).
+DEFAULT_HEADERS = {
+    'Accept': 'application/json',
+    'User-Agent': 'kapci-agent/1.0',
+    **make_headers(accept_encoding=True)
+}
+
+# (connect, read) timeouts: lookups fail fast, writes get more read time
+LOOKUP_TIMEOUT = (2, 5)
+WRITE_TIMEOUT = (2, 10)
+SLOW_WRITE_TIMEOUT = (2, 15)
+
+# Circuit breaker: open after this many consecutive failures, probe again later
+BREAKER_FAIL_MAX = 5
+BREAKER_RESET_TIMEOUT = 30
+
+# Cache TTLs (seconds) for read-mostly lookups
+CUSTOMER_CACHE_TTL = 600
+PRODUCT_INFO_CACHE_TTL = 3600
+PRODUCT_PRICE_CACHE_TTL = 300
+
+# Stale copies are kept longer and served while a backend's breaker is open
+STALE_CACHE_TTL = 24 * 3600
+
+# Redis client, set by init_external_services when REDIS_URL is configured
+redis_client = None
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """Raised instead of calling a backend whose circuit breaker is open"""
+
+
+class CircuitBreakerAdapter(HTTPAdapter):
+    """
+    HTTPAdapter that stops calling a backend after repeated failures
+    
+    Connection errors, timeouts and 5xx responses (including retries
+    exhausted on them) count as failures. After BREAKER_FAIL_MAX in a row the
+    circuit opens and requests fail immediately with CircuitOpenError for
+    BREAKER_RESET_TIMEOUT seconds. Then a single request is let through as a
+    probe while the rest keep failing fast; its outcome closes or reopens
+    the circuit.
+    """
+    
+    def __init__(self, *args, fail_max: int = BREAKER_FAIL_MAX,
+                 reset_timeout: float = BREAKER_RESET_TIMEOUT, **kwargs):
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+    
+    def send(self, request, **kwargs):
+        with self._lock:
+            probe = self._opened_at is not None
+            if probe:
+                if self._probing or time.monotonic() - self._opened_at < self.reset_timeout:
+                    raise CircuitOpenError(f"Circuit open for {request.url}", request=request)
+                # Half-open: this request is the one probe
+                self._probing = True
+        
+        try:
+            response = super().send(request, **kwargs)
+        except requests.Timeout:
+            self._record_failure(request, 'timeout')
+            raise
+        except requests.ConnectionError:
+            self._record_failure(request, 'connection error')
+            raise
+        except requests.exceptions.RetryError:
+            self._record_failure(request, 'retries exhausted')
+            raise
+        except Exception:
+            # Not a backend failure; just free the probe slot
+            if probe:
+                with self._lock:
+                    self._probing = False
+            raise
+        
+        if response.status_code >= 500:
+            self._record_failure(request, f'HTTP {response.status_code}')
+        else:
+            with self._lock:
+                self._failures = 0
+                self._opened_at = None
+                self._probing = False
+        return response
+    
+    def _record_failure(self, request, reason: str) -> None:
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._failures >= self.fail_max:
+                self._opened_at = time.monotonic()
+                logger.warning(f"Circuit opened for {request.url} after {reason}")
+
+
+def _build_session(headers: Dict) -> requests.Session:
+    """
+    Build a pooled keep-alive session for one backend
+    
+    Only idempotent methods are retried so refunds and credit notes
+    are never submitted twice.
+    """
+    session = requests.Session()
+    session.headers.update(DEFAULT_HEADERS)
+    session.headers.update(headers)
+    
+    adapter = CircuitBreakerAdapter(
+        pool_connections=POOL_CONNECTIONS,
+        pool_maxsize=POOL_MAXSIZE,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.2,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(['GET', 'PUT'])
+        )
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _parse_json(response: requests.Response):
+    """Decode a response body with orjson"""
+    return orjson.loads(response.content)
+
+
+def _cache_get(key: str):
+    """Get a cached payload, or None on miss or when caching is off"""
+    if redis_client is None:
+        return None
+    try:
+        value = redis_client.get(key)
+    except Exception as e:
+        logger.warning(f"Redis cache error: {e}")
+        return None
+    return orjson.loads(value) if value is not None else None
+
+
+def _cache_set(key: str, ttl: int, payload) -> None:
+    """Cache a payload for ttl seconds, plus a long-lived stale copy"""
+    if redis_client is None:
+        return
+    value = orjson.dumps(payload)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.setex(key, ttl, value)
+        pipe.setex(f'{key}:stale', STALE_CACHE_TTL, value)
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"Redis cache error: {e}")
+
+
+def _cache_delete(*keys: str) -> None:
+    """Drop cached payloads"""
+    if redis_client is None or not keys:
+        return
+    try:
+        redis_client.delete(*keys)
+    except Exception as e:
+        logger.warning(f"Redis cache error: {e}")
+
 
 class CRMService:
     """Customer Relationship Management API Integration"""
@@ -20,6 +198,7 @@ class CRMService:
             'Authorization': f'Bearer {api_key}',
             'Content-Type': 'application/json'
         }
+        self.session = _build_session(self.headers)
     
     def get_customer(self, phone: str) -> Optional[Dict]:
         """
@@ -31,30 +210,46 @@ class CRMService:
         Returns:
             Customer data dict or None
         """
+        key = f'crm:cust:{phone}'
+        cached = _cache_get(key)
+        if cached is not None:
+            return cached
+        
         try:
-            response = requests.get(
+            response = self.session.get(
                 f'{self.base_url}/customers/phone/{phone}',
-                headers=self.headers,
-                timeout=10
+                timeout=LOOKUP_TIMEOUT
             )
             if response.status_code == 200:
-                return response.json()
+                customer = _parse_json(response)
+                _cache_set(key, CUSTOMER_CACHE_TTL, customer)
+                return customer
             return None
+        except CircuitOpenError:
+            return _cache_get(f'{key}:stale')
         except Exception as e:
             logger.error(f"CRM API error: {e}")
             return None
     
     def get_customer_by_account(self, account_id: str) -> Optional[Dict]:
         """Get customer by KAPCI account ID"""
+        key = f'crm:acct:{account_id}'
+        cached = _cache_get(key)
+        if cached is not None:
+            return cached
+        
         try:
-            response = requests.get(
+            response = self.session.get(
                 f'{self.base_url}/customers/account/{account_id}',
-                headers=self.headers,
-                timeout=10
+                timeout=LOOKUP_TIMEOUT
             )
             if response.status_code == 200:
-                return response.json()
+                customer = _parse_json(response)
+                _cache_set(key, CUSTOMER_CACHE_TTL, customer)
+                return customer
             return None
+        except CircuitOpenError:
+            return _cache_get(f'{key}:stale')
         except Exception as e:
             logger.error(f"CRM API error: {e}")
             return None
@@ -62,14 +257,13 @@ class CRMService:
     def create_customer(self, data: Dict) -> Optional[Dict]:
         """Create new customer in CRM"""
         try:
-            response = requests.post(
+            response = self.session.post(
                 f'{self.base_url}/customers',
-                headers=self.headers,
-                json=data,
-                timeout=10
+                data=orjson.dumps(data),
+                timeout=WRITE_TIMEOUT
             )
             if response.status_code in [200, 201]:
-                return response.json()
+                return _parse_json(response)
             return None
         except Exception as e:
             logger.error(f"CRM API error: {e}")
@@ -78,27 +272,39 @@ class CRMService:
     def update_customer(self, customer_id: str, data: Dict) -> Optional[Dict]:
         """Update customer information"""
         try:
-            response = requests.put(
+            response = self.session.put(
                 f'{self.base_url}/customers/{customer_id}',
-                headers=self.headers,
-                json=data,
-                timeout=10
+                data=orjson.dumps(data),
+                timeout=WRITE_TIMEOUT
             )
             if response.status_code == 200:
-                return response.json()
+                customer = _parse_json(response)
+                self.invalidate_customer(
+                    phone=customer.get('phone') or data.get('phone'),
+                    account_id=customer.get('account_id') or data.get('account_id')
+                )
+                return customer
             return None
         except Exception as e:
             logger.error(f"CRM API error: {e}")
             return None
     
+    def invalidate_customer(self, phone: str = None, account_id: str = None) -> None:
+        """Drop cached customer lookups after the record changes"""
+        keys = []
+        if phone:
+            keys.append(f'crm:cust:{phone}')
+        if account_id:
+            keys.append(f'crm:acct:{account_id}')
+        _cache_delete(*keys)
+    
     def log_interaction(self, customer_id: str, interaction: Dict) -> bool:
         """Log customer interaction"""
         try:
-            response = requests.post(
+            response = self.session.post(
                 f'{self.base_url}/customers/{customer_id}/interactions',
-                headers=self.headers,
-                json=interaction,
-                timeout=10
+                data=orjson.dumps(interaction),
+                timeout=WRITE_TIMEOUT
             )
             return response.status_code in [200, 201]
         except Exception as e:
@@ -116,6 +322,7 @@ class ERPService:
             'Authorization': f'Bearer {api_key}',
             'Content-Type': 'application/json'
         }
+        self.session = _build_session(self.headers)
     
     def create_credit_note(self, data: Dict) -> Optional[Dict]:
         """
@@ -128,14 +335,13 @@ class ERPService:
             Credit note details or None
         """
         try:
-            response = requests.post(
+            response = self.session.post(
                 f'{self.base_url}/finance/credit-notes',
-                headers=self.headers,
-                json=data,
-                timeout=15
+                data=orjson.dumps(data),
+                timeout=SLOW_WRITE_TIMEOUT
             )
             if response.status_code in [200, 201]:
-                return response.json()
+                return _parse_json(response)
             return None
         except Exception as e:
             logger.error(f"ERP API error: {e}")
@@ -144,13 +350,12 @@ class ERPService:
     def get_credit_note_status(self, credit_note_id: str) -> Optional[Dict]:
         """Get credit note status"""
         try:
-            response = requests.get(
+            response = self.session.get(
                 f'{self.base_url}/finance/credit-notes/{credit_note_id}',
-                headers=self.headers,
-                timeout=10
+                timeout=LOOKUP_TIMEOUT
             )
             if response.status_code == 200:
-                return response.json()
+                return _parse_json(response)
             return None
         except Exception as e:
             logger.error(f"ERP API error: {e}")
@@ -170,19 +375,18 @@ class ERPService:
             Transaction details or None
         """
         try:
-            response = requests.post(
+            response = self.session.post(
                 f'{self.base_url}/finance/refunds',
-                headers=self.headers,
-                json={
+                data=orjson.dumps({
                     'customer_account': customer_account,
                     'amount': amount,
                     'reference': reference,
                     'type': 'compensation_refund'
-                },
-                timeout=15
+                }),
+                timeout=SLOW_WRITE_TIMEOUT
             )
             if response.status_code in [200, 201]:
-                return response.json()
+                return _parse_json(response)
             return None
         except Exception as e:
             logger.error(f"ERP API error: {e}")
@@ -190,16 +394,25 @@ class ERPService:
     
     def get_product_price(self, product_sku: str) -> Optional[float]:
         """Get product price from ERP"""
+        key = f'erp:price:{product_sku}'
+        cached = _cache_get(key)
+        if cached is not None:
+            return cached
+        
         try:
-            response = requests.get(
+            response = self.session.get(
                 f'{self.base_url}/products/{product_sku}/price',
-                headers=self.headers,
-                timeout=10
+                timeout=LOOKUP_TIMEOUT
             )
             if response.status_code == 200:
-                data = response.json()
-                return data.get('price')
+                data = _parse_json(response)
+                price = data.get('price')
+                if price is not None:
+                    _cache_set(key, PRODUCT_PRICE_CACHE_TTL, price)
+                return price
             return None
+        except CircuitOpenError:
+            return _cache_get(f'{key}:stale')
         except Exception as e:
             logger.error(f"ERP API error: {e}")
             return None
@@ -215,6 +428,7 @@ class InventoryService:
             'Authorization': f'Bearer {api_key}',
             'Content-Type': 'application/json'
         }
+        self.session = _build_session(self.headers)
     
     def check_stock(self, product_sku: str, quantity: int = 1) -> Dict:
         """
@@ -228,14 +442,13 @@ class InventoryService:
             Stock status dict
         """
         try:
-            response = requests.get(
+            response = self.session.get(
                 f'{self.base_url}/inventory/check',
-                headers=self.headers,
                 params={'sku': product_sku, 'qty': quantity},
-                timeout=10
+                timeout=LOOKUP_TIMEOUT
             )
             if response.status_code == 200:
-                return response.json()
+                return _parse_json(response)
             return {'available': False, 'quantity': 0}
         except Exception as e:
             logger.error(f"Inventory API error: {e}")
@@ -255,19 +468,18 @@ class InventoryService:
             Reservation details or None
         """
         try:
-            response = requests.post(
+            response = self.session.post(
                 f'{self.base_url}/inventory/reserve',
-                headers=self.headers,
-                json={
+                data=orjson.dumps({
                     'sku': product_sku,
                     'quantity': quantity,
                     'reference': reference,
                     'type': 'compensation_replacement'
-                },
-                timeout=10
+                }),
+                timeout=WRITE_TIMEOUT
             )
             if response.status_code in [200, 201]:
-                return response.json()
+                return _parse_json(response)
             return None
         except Exception as e:
             logger.error(f"Inventory API error: {e}")
@@ -284,14 +496,13 @@ class InventoryService:
             Delivery order details with tracking
         """
         try:
-            response = requests.post(
+            response = self.session.post(
                 f'{self.base_url}/delivery/orders',
-                headers=self.headers,
-                json=data,
-                timeout=15
+                data=orjson.dumps(data),
+                timeout=SLOW_WRITE_TIMEOUT
             )
             if response.status_code in [200, 201]:
-                return response.json()
+                return _parse_json(response)
             return None
         except Exception as e:
             logger.error(f"Inventory API error: {e}")
@@ -300,13 +511,12 @@ class InventoryService:
     def get_delivery_status(self, tracking_number: str) -> Optional[Dict]:
         """Get delivery status by tracking number"""
         try:
-            response = requests.get(
+            response = self.session.get(
                 f'{self.base_url}/delivery/track/{tracking_number}',
-                headers=self.headers,
-                timeout=10
+                timeout=LOOKUP_TIMEOUT
             )
             if response.status_code == 200:
-                return response.json()
+                return _parse_json(response)
             return None
         except Exception as e:
             logger.error(f"Inventory API error: {e}")
@@ -314,41 +524,76 @@ class InventoryService:
     
     def get_product_info(self, product_sku: str) -> Optional[Dict]:
         """Get product information"""
+        key = f'inv:product:{product_sku}'
+        cached = _cache_get(key)
+        if cached is not None:
+            return cached
+        
         try:
-            response = requests.get(
+            response = self.session.get(
                 f'{self.base_url}/products/{product_sku}',
-                headers=self.headers,
-                timeout=10
+                timeout=LOOKUP_TIMEOUT
             )
             if response.status_code == 200:
-                return response.json()
+                product = _parse_json(response)
+                _cache_set(key, PRODUCT_INFO_CACHE_TTL, product)
+                return product
             return None
+        except CircuitOpenError:
+            return _cache_get(f'{key}:stale')
         except Exception as e:
             logger.error(f"Inventory API error: {e}")
             return None
 
 
-# Singleton instances (initialized with app config)
-crm_service = CRMService()
-erp_service = ERPService()
-inventory_service = InventoryService()
+# Service accessors: each service and its connection pool is built on first
+# use with the current app's configuration, then shared across threads.
+
+def _service_config(prefix: str) -> Dict:
+    """Get base_url/api_key for a backend from the app config, if available"""
+    if not has_app_context():
+        return {}
+    return {
+        'base_url': current_app.config.get(f'{prefix}_API_URL'),
+        'api_key': current_app.config.get(f'{prefix}_API_KEY')
+    }
+
+
+@lru_cache(maxsize=1)
+def get_crm_service() -> CRMService:
+    """Get the shared CRM service"""
+    return CRMService(**_service_config('CRM'))
+
+
+@lru_cache(maxsize=1)
+def get_erp_service() -> ERPService:
+    """Get the shared ERP service"""
+    return ERPService(**_service_config('ERP'))
+
+
+@lru_cache(maxsize=1)
+def get_inventory_service() -> InventoryService:
+    """Get the shared inventory service"""
+    return InventoryService(**_service_config('INVENTORY'))
 
 
 def init_external_services(app):
     """Initialize external services with app configuration"""
-    global crm_service, erp_service, inventory_service
+    global redis_client
     
-    crm_service = CRMService(
-        base_url=app.config.get('CRM_API_URL'),
-        api_key=app.config.get('CRM_API_KEY')
-    )
+    redis_url = app.config.get('REDIS_URL')
+    if redis_url:
+        import redis
+        redis_client = redis.Redis(connection_pool=redis.BlockingConnectionPool.from_url(
+            redis_url, max_connections=32
+        ))
     
-    erp_service = ERPService(
-        base_url=app.config.get('ERP_API_URL'),
-        api_key=app.config.get('ERP_API_KEY')
-    )
+    # Rebuild the services against this app's configuration
+    for accessor in (get_crm_service, get_erp_service, get_inventory_service):
+        accessor.cache_clear()
     
-    inventory_service = InventoryService(
-        base_url=app.config.get('INVENTORY_API_URL'),
-        api_key=app.config.get('INVENTORY_API_KEY')
-    )
+    with app.app_context():
+        get_crm_service()
+        get_erp_service()
+        get_inventory_service()
+
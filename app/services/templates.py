@@ -2,9 +2,50 @@
 KAPCI WhatsApp AI Agent - Message Templates
 Bilingual Templates (Arabic + English)
 """
-from typing import Optional
+from datetime import datetime
+from functools import lru_cache
+from string import Formatter
+from typing import Callable, Dict, Optional
 from app.models import Ticket, TicketStatus
 
+# Language used when a customer's language has no template
+DEFAULT_LANG = 'ar'
+
+
+def _compile_template(template: str) -> Callable[..., str]:
+    """
+    Pre-split a str.format template into (literal, field) parts
+    
+    The template is parsed once here instead of on every .format() call;
+    rendering just joins the parts. Only plain {name} fields are supported.
+    """
+    parts = []
+    for literal, field, spec, conversion in Formatter().parse(template):
+        if field is not None and (not field.isidentifier() or spec or conversion):
+            raise ValueError(f"Unsupported template field: {field!r}")
+        parts.append((literal, field))
+    parts = tuple(parts)
+    
+    def render(**values) -> str:
+        return ''.join([
+            literal if field is None else literal + format(values[field])
+            for literal, field in parts
+        ])
+    
+    return render
+
+
+class _LangDict(dict):
+    """Per-language mapping that falls back to DEFAULT_LANG for unknown languages"""
+    
+    def __missing__(self, lang):
+        return self[DEFAULT_LANG]
+
+
+def _compile_langs(templates: Dict[str, str]) -> _LangDict:
+    """Compile each language variant of a template"""
+    return _LangDict({lang: _compile_template(template) for lang, template in templates.items()})
+
 
 class MessageTemplates:
     """Message Templates Manager"""
@@ -13,7 +54,7 @@ class MessageTemplates:
     # GREETING & MENU
     # ==========================================
     
-    GREETING = {
+    GREETING = _LangDict({
         'ar': """مرحباً! 👋 أنا مساعد كابسي الذكي.
 
 كيف يمكنني مساعدتك اليوم؟
@@ -29,13 +70,13 @@ How can I help you today?
 1️⃣ Submit Product Complaint
 2️⃣ Track Existing Complaint
 3️⃣ Help"""
-    }
+    })
     
     # ==========================================
     # DATA COLLECTION
     # ==========================================
     
-    ASK_PRODUCT = {
+    ASK_PRODUCT = _LangDict({
         'ar': """📦 من فضلك أخبرني عن المنتج المُشتكى منه:
 
 • اسم المنتج
@@ -49,9 +90,9 @@ How can I help you today?
 • Purchase date (if known)
 
 Example: "White paint 10L, bought last week" """
-    }
+    })
     
-    ASK_ISSUE = {
+    ASK_ISSUE = _LangDict({
         'ar': """📝 شكراً! الآن من فضلك اشرح المشكلة بالتفصيل:
 
 ما المشكلة التي واجهتها مع هذا المنتج؟""",
@@ -59,9 +100,9 @@ Example: "White paint 10L, bought last week" """
         'en': """📝 Thanks! Now please describe the issue in detail:
 
 What problem did you experience with this product?"""
-    }
+    })
     
-    ASK_PHOTOS = {
+    ASK_PHOTOS = _LangDict({
         'ar': """📷 هل تريد إرسال صور للمشكلة؟
 
 يمكنك إرسال صور الآن، أو اكتب "تخطي" للمتابعة بدون صور.""",
@@ -69,13 +110,13 @@ What problem did you experience with this product?"""
         'en': """📷 Would you like to send photos of the issue?
 
 You can send photos now, or type "skip" to continue without photos."""
-    }
+    })
     
     # ==========================================
     # CONFIRMATION
     # ==========================================
     
-    CONFIRM_DATA = {
+    CONFIRM_DATA = _LangDict({
         'ar': """📋 ملخص الشكوى:
 
 🏭 المنتج: {product}
@@ -93,9 +134,9 @@ You can send photos now, or type "skip" to continue without photos."""
 Is this information correct?
 ✅ Yes - to submit complaint
 ❌ No - to edit information"""
-    }
+    })
     
-    CONFIRM_PROMPT = {
+    CONFIRM_PROMPT = _LangDict({
         'ar': """من فضلك أجب بـ:
 ✅ نعم - لتأكيد الشكوى
 ❌ لا - لتعديل المعلومات""",
@@ -103,13 +144,13 @@ Is this information correct?
         'en': """Please answer:
 ✅ Yes - to confirm complaint
 ❌ No - to edit information"""
-    }
+    })
     
     # ==========================================
     # TICKET CREATED
     # ==========================================
     
-    TICKET_CREATED = {
+    TICKET_CREATED = _LangDict({
         'ar': """✅ تم إنشاء الشكوى بنجاح!
 
 🎫 رقم التذكرة: {ticket_number}
@@ -127,13 +168,13 @@ Our technical team will review your complaint within 48 hours.
 We'll notify you of the result through this chat.
 
 Thank you for contacting us! 🙏"""
-    }
+    })
     
     # ==========================================
     # TICKET STATUS
     # ==========================================
     
-    TICKET_STATUS = {
+    TICKET_STATUS = _LangDict({
         'ar': """📊 حالة الشكوى
 
 🎫 رقم التذكرة: {ticket_number}
@@ -151,9 +192,9 @@ Thank you for contacting us! 🙏"""
 🏭 Product: {product}
 
 {extra_info}"""
-    }
+    })
     
-    STATUS_MAP = {
+    STATUS_MAP = _LangDict({
         'ar': {
             'pending_review': '⏳ قيد المراجعة الفنية',
             'under_review': '🔍 تحت المراجعة',
@@ -178,13 +219,13 @@ Thank you for contacting us! 🙏"""
             'in_delivery': '🚚 In Delivery',
             'completed': '✅ Completed'
         }
-    }
+    })
     
     # ==========================================
     # NOTIFICATIONS
     # ==========================================
     
-    TICKET_REJECTED = {
+    TICKET_REJECTED = _LangDict({
         'ar': """❌ تحديث بخصوص شكواك
 
 🎫 رقم التذكرة: {ticket_number}
@@ -204,9 +245,9 @@ After technical review, no product issue was found.
 📝 Reason: {reason}
 
 If you have questions or additional information, we're here to help."""
-    }
+    })
     
-    TICKET_APPROVED_REFUND = {
+    TICKET_APPROVED_REFUND = _LangDict({
         'ar': """✅ أخبار سارة!
 
 🎫 رقم التذكرة: {ticket_number}
@@ -228,9 +269,9 @@ Your complaint has been approved! 🎉
 The amount will be credited to your registered account.
 
 Thank you for your patience! 🙏"""
-    }
+    })
     
-    TICKET_APPROVED_REPLACEMENT = {
+    TICKET_APPROVED_REPLACEMENT = _LangDict({
         'ar': """✅ أخبار سارة!
 
 🎫 رقم التذكرة: {ticket_number}
@@ -252,13 +293,13 @@ Your complaint has been approved! 🎉
 We'll notify you with tracking information when shipped.
 
 Thank you for your patience! 🙏"""
-    }
+    })
     
     # ==========================================
     # MISC
     # ==========================================
     
-    NO_TICKETS = {
+    NO_TICKETS = _LangDict({
         'ar': """📭 لم يتم العثور على شكاوى سابقة.
 
 لتقديم شكوى جديدة، اكتب 1 أو "شكوى" """,
@@ -266,9 +307,9 @@ Thank you for your patience! 🙏"""
         'en': """📭 No previous complaints found.
 
 To submit a new complaint, type 1 or "complaint" """
-    }
+    })
     
-    UNKNOWN = {
+    UNKNOWN = _LangDict({
         'ar': """عذراً، لم أفهم طلبك. 🤔
 
 اختر من القائمة:
@@ -282,9 +323,9 @@ Choose from the menu:
 1️⃣ New Complaint
 2️⃣ Track Complaint
 3️⃣ Help"""
-    }
+    })
     
-    HELP = {
+    HELP = _LangDict({
         'ar': """📖 المساعدة
 
 أنا مساعد كابسي الذكي، يمكنني مساعدتك في:
@@ -314,9 +355,9 @@ Steps:
 • We'll notify you of the result
 
 Would you like to submit a complaint now?"""
-    }
+    })
     
-    THANKS_RESPONSE = {
+    THANKS_RESPONSE = _LangDict({
         'ar': """شكراً لتواصلك معنا! 🙏
 
 هل هناك شيء آخر يمكنني مساعدتك به؟""",
@@ -324,9 +365,9 @@ Would you like to submit a complaint now?"""
         'en': """Thank you for contacting us! 🙏
 
 Is there anything else I can help you with?"""
-    }
+    })
     
-    CANCELLED = {
+    CANCELLED = _LangDict({
         'ar': """تم إلغاء العملية. ✋
 
 إذا احتجت المساعدة، أنا هنا!""",
@@ -334,14 +375,14 @@ Is there anything else I can help you with?"""
         'en': """Operation cancelled. ✋
 
 If you need help, I'm here!"""
-    }
+    })
     
-    RESTART = {
+    RESTART = _LangDict({
         'ar': """لا مشكلة، لنبدأ من جديد.""",
         'en': """No problem, let's start again."""
-    }
+    })
     
-    REMINDER = {
+    REMINDER = _LangDict({
         'ar': {
             'pending_review': """⏰ تذكير: شكواك رقم {ticket_number} قيد المراجعة.
 سيقوم فريقنا بالرد قريباً.""",
@@ -352,84 +393,114 @@ If you need help, I'm here!"""
 Our team will respond soon.""",
             'awaiting_customer': """⏰ Reminder: We need your response for ticket {ticket_number}."""
         }
-    }
+    })
+    
+    # ==========================================
+    # COMPILED RENDERERS
+    # ==========================================
+    
+    _CONFIRM_DATA = _compile_langs(CONFIRM_DATA)
+    _TICKET_CREATED = _compile_langs(TICKET_CREATED)
+    _TICKET_STATUS = _compile_langs(TICKET_STATUS)
+    _TICKET_REJECTED = _compile_langs(TICKET_REJECTED)
+    _TICKET_APPROVED_REFUND = _compile_langs(TICKET_APPROVED_REFUND)
+    _TICKET_APPROVED_REPLACEMENT = _compile_langs(TICKET_APPROVED_REPLACEMENT)
+    _REMINDER = _LangDict({lang: _compile_langs(reminders) for lang, reminders in REMINDER.items()})
+    
+    # Pre-bound label lookups; call as _STATUS_LABEL[lang](status, status)
+    _STATUS_LABEL = _LangDict({lang: labels.get for lang, labels in STATUS_MAP.items()})
     
     # ==========================================
     # GETTER METHODS
     # ==========================================
     
     def get_greeting(self, lang: str = 'ar') -> str:
-        return self.GREETING.get(lang, self.GREETING['ar'])
+        return self.GREETING[lang]
     
     def get_ask_product(self, lang: str = 'ar') -> str:
-        return self.ASK_PRODUCT.get(lang, self.ASK_PRODUCT['ar'])
+        return self.ASK_PRODUCT[lang]
     
     def get_ask_issue(self, lang: str = 'ar') -> str:
-        return self.ASK_ISSUE.get(lang, self.ASK_ISSUE['ar'])
+        return self.ASK_ISSUE[lang]
     
     def get_ask_photos(self, lang: str = 'ar') -> str:
-        return self.ASK_PHOTOS.get(lang, self.ASK_PHOTOS['ar'])
+        return self.ASK_PHOTOS[lang]
     
     def get_confirm_data(self, product: str, issue: str, lang: str = 'ar') -> str:
-        template = self.CONFIRM_DATA.get(lang, self.CONFIRM_DATA['ar'])
-        return template.format(product=product, issue=issue)
+        render = self._CONFIRM_DATA[lang]
+        return render(product=product, issue=issue)
     
     def get_confirm_prompt(self, lang: str = 'ar') -> str:
-        return self.CONFIRM_PROMPT.get(lang, self.CONFIRM_PROMPT['ar'])
+        return self.CONFIRM_PROMPT[lang]
     
     def get_ticket_created(self, ticket_number: str, lang: str = 'ar') -> str:
-        template = self.TICKET_CREATED.get(lang, self.TICKET_CREATED['ar'])
-        return template.format(ticket_number=ticket_number)
+        render = self._TICKET_CREATED[lang]
+        return render(ticket_number=ticket_number)
     
     def get_ticket_status(self, ticket: Ticket, lang: str = 'ar') -> str:
-        template = self.TICKET_STATUS.get(lang, self.TICKET_STATUS['ar'])
-        status_map = self.STATUS_MAP.get(lang, self.STATUS_MAP['ar'])
+        # Only hashable scalars go to the cache, never the ORM object
+        return self._render_ticket_status(
+            lang,
+            ticket.ticket_number,
+            ticket.created_at,
+            ticket.status,
+            ticket.product_name,
+            ticket.compensation_type
+        )
+    
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def _render_ticket_status(lang: str, ticket_number: str, created_at: datetime,
+                              status: str, product_name: Optional[str],
+                              compensation_type: Optional[str]) -> str:
+        """Render a ticket status message, memoized for repeat status checks"""
+        render = MessageTemplates._TICKET_STATUS[lang]
         
         extra_info = ""
-        if ticket.compensation_type == 'refund':
+        if compensation_type == 'refund':
             extra_info = "💰 نوع التعويض: استرداد مبلغ" if lang == 'ar' else "💰 Compensation: Refund"
-        elif ticket.compensation_type == 'replacement':
+        elif compensation_type == 'replacement':
             extra_info = "📦 نوع التعويض: استبدال منتج" if lang == 'ar' else "📦 Compensation: Replacement"
         
-        return template.format(
-            ticket_number=ticket.ticket_number,
-            created_date=ticket.created_at.strftime('%Y-%m-%d'),
-            status=status_map.get(ticket.status, ticket.status),
-            product=ticket.product_name or '-',
+        return render(
+            ticket_number=ticket_number,
+            created_date=created_at.date().isoformat(),
+            status=MessageTemplates._STATUS_LABEL[lang](status, status),
+            product=product_name or '-',
             extra_info=extra_info
         )
     
     def get_no_tickets(self, lang: str = 'ar') -> str:
-        return self.NO_TICKETS.get(lang, self.NO_TICKETS['ar'])
+        return self.NO_TICKETS[lang]
     
     def get_unknown(self, lang: str = 'ar') -> str:
-        return self.UNKNOWN.get(lang, self.UNKNOWN['ar'])
+        return self.UNKNOWN[lang]
     
     def get_help(self, lang: str = 'ar') -> str:
-        return self.HELP.get(lang, self.HELP['ar'])
+        return self.HELP[lang]
     
     def get_thanks_response(self, lang: str = 'ar') -> str:
-        return self.THANKS_RESPONSE.get(lang, self.THANKS_RESPONSE['ar'])
+        return self.THANKS_RESPONSE[lang]
     
     def get_cancelled(self, lang: str = 'ar') -> str:
-        return self.CANCELLED.get(lang, self.CANCELLED['ar'])
+        return self.CANCELLED[lang]
     
     def get_restart(self, lang: str = 'ar') -> str:
-        return self.RESTART.get(lang, self.RESTART['ar'])
+        return self.RESTART[lang]
     
     def get_ticket_rejected(self, ticket_number: str, reason: str, lang: str = 'ar') -> str:
-        template = self.TICKET_REJECTED.get(lang, self.TICKET_REJECTED['ar'])
-        return template.format(ticket_number=ticket_number, reason=reason)
+        render = self._TICKET_REJECTED[lang]
+        return render(ticket_number=ticket_number, reason=reason)
     
     def get_ticket_approved_refund(self, ticket_number: str, lang: str = 'ar') -> str:
-        template = self.TICKET_APPROVED_REFUND.get(lang, self.TICKET_APPROVED_REFUND['ar'])
-        return template.format(ticket_number=ticket_number)
+        render = self._TICKET_APPROVED_REFUND[lang]
+        return render(ticket_number=ticket_number)
     
     def get_ticket_approved_replacement(self, ticket_number: str, lang: str = 'ar') -> str:
-        template = self.TICKET_APPROVED_REPLACEMENT.get(lang, self.TICKET_APPROVED_REPLACEMENT['ar'])
-        return template.format(ticket_number=ticket_number)
+        render = self._TICKET_APPROVED_REPLACEMENT[lang]
+        return render(ticket_number=ticket_number)
     
     def get_reminder(self, ticket_number: str, reminder_type: str, lang: str = 'ar') -> str:
-        reminders = self.REMINDER.get(lang, self.REMINDER['ar'])
-        template = reminders.get(reminder_type, reminders.get('pending_review'))
-        return template.format(ticket_number=ticket_number)
+        reminders = self._REMINDER[lang]
+        render = reminders.get(reminder_type, reminders['pending_review'])
+        return render(ticket_number=ticket_number)
@@ -3,14 +3,73 @@ KAPCI WhatsApp AI Agent - Ticket Service
 Ticket Management and Operations
 """
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
-from sqlalchemy import and_, or_
+from typing import Dict, List, Optional, Union
+from flask import g, has_request_context
+from sqlalchemy import and_, or_, case, event, func, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, contains_eager, joinedload, undefer_group
 
 from app.models import (
-    db, Ticket, Customer, Technician, TicketStatusHistory,
+    db, Ticket, Customer, Technician, TicketStatusHistory, TicketCounter,
     TicketStatus, TechnicalDecision, CompensationType
 )
 
+# Attempts at drawing a free ticket number before giving up
+TICKET_NUMBER_ATTEMPTS = 3
+
+# Ticket columns that update_ticket() may write from caller-supplied data.
+# Status is not among them: it changes through update_status() and the
+# workflow methods, which log history and keep ticket_counters in step.
+TICKET_WRITABLE_FIELDS = frozenset({
+    'product_name', 'product_sku', 'purchase_date', 'quantity',
+    'issue_description', 'issue_category', 'photos', 'priority'
+})
+
+# Session.info key holding history rows waiting for flush_history()
+PENDING_HISTORY_KEY = 'pending_status_history'
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_pending_history(session, previous_transaction):
+    """Drop queued history rows along with the transaction they belonged to"""
+    # Savepoints and the flush's own subtransaction roll back without ending
+    # the outer transaction, whose rows stay queued; only the root counts
+    if previous_transaction.parent is not None:
+        return
+    session.info.pop(PENDING_HISTORY_KEY, None)
+
+
+def _ticket_relation_options():
+    """
+    Loader options that fetch a ticket's customer and technician in the same SELECT
+    
+    Built per call because the relationships are backrefs that only exist
+    once the mappers are configured.
+    """
+    return (
+        joinedload(Ticket.customer),
+        joinedload(Ticket.assigned_technician)
+    )
+
+
+def _serialized_ticket_options():
+    """Loader options for tickets serialized with to_dict(): relations plus detail columns"""
+    return (undefer_group('details'), *_ticket_relation_options())
+
+
+def _request_now() -> datetime:
+    """
+    Current naive UTC time, read once per request
+    
+    Every timestamp written while handling one request shares a single
+    value. Outside a request (jobs, shell) the clock is read on each call.
+    """
+    if not has_request_context():
+        return datetime.utcnow()
+    if 'now' not in g:
+        g.now = datetime.utcnow()
+    return g.now
+
 
 class TicketService:
     """Ticket Management Service"""
@@ -27,7 +86,6 @@ class TicketService:
             Created ticket
         """
         ticket = Ticket(
-            ticket_number=Ticket.generate_ticket_number(),
             customer_id=customer_id,
             product_name=data.get('product_name'),
             product_sku=data.get('product_sku'),
@@ -36,24 +94,44 @@ class TicketService:
             issue_description=data.get('issue_description'),
             issue_category=data.get('issue_category'),
             photos=data.get('photos', []),
-            status=TicketStatus.PENDING_REVIEW.value,
+            status=TicketStatus.PENDING_REVIEW,
             priority=data.get('priority', 'normal')
         )
         
-        db.session.add(ticket)
-        db.session.commit()
+        # Pick the technician first so the assignment goes out with the
+        # INSERT (whose RETURNING supplies the id) instead of a later UPDATE
+        technician = self._pick_technician()
+        if technician:
+            ticket.assigned_technician_id = technician.id
+        
+        # Retry on the rare ticket number collision; the savepoint keeps a
+        # failed insert from discarding the rest of the transaction
+        for attempt in range(TICKET_NUMBER_ATTEMPTS):
+            ticket.ticket_number = Ticket.generate_ticket_number()
+            try:
+                with db.session.begin_nested():
+                    db.session.add(ticket)
+            except IntegrityError:
+                if attempt == TICKET_NUMBER_ATTEMPTS - 1:
+                    raise
+            else:
+                break
         
         # Log status change
-        self._log_status_change(ticket.id, None, TicketStatus.PENDING_REVIEW.value, 'System', 'Ticket created')
+        self._log_status_change(ticket.id, None, TicketStatus.PENDING_REVIEW, 'System', 'Ticket created')
         
         # Auto-assign technician
-        self.assign_technician(ticket.id)
+        if technician:
+            self._record_assignment(ticket, technician)
+        
+        # Ticket, history and assignment land in one commit
+        self._commit()
         
         return ticket
     
     def get_ticket(self, ticket_id: int) -> Optional[Ticket]:
         """Get ticket by ID"""
-        return Ticket.query.get(ticket_id)
+        return db.session.get(Ticket, ticket_id, options=_serialized_ticket_options())
     
     def get_ticket_by_number(self, ticket_number: str) -> Optional[Ticket]:
         """Get ticket by ticket number"""
@@ -61,26 +139,107 @@ class TicketService:
     
     def get_customer_tickets(self, customer_id: int, limit: int = 10) -> List[Ticket]:
         """Get tickets for a customer"""
-        return Ticket.query.filter_by(customer_id=customer_id)\
+        return Ticket.query.options(*_serialized_ticket_options())\
+            .filter_by(customer_id=customer_id)\
             .order_by(Ticket.created_at.desc())\
             .limit(limit).all()
     
-    def get_tickets_by_status(self, status: str) -> List[Ticket]:
-        """Get tickets by status"""
-        return Ticket.query.filter_by(status=status)\
-            .order_by(Ticket.created_at.asc()).all()
+    def get_customer_tickets_by_phone(self, phone: str, limit: int = 10) -> List[Ticket]:
+        """
+        Get tickets for a customer phone number in a single query
+        
+        The customer row is joined into the same SELECT, so callers that
+        need both avoid a separate customer lookup when tickets exist.
+        """
+        return Ticket.query.join(Ticket.customer)\
+            .options(
+                contains_eager(Ticket.customer),
+                joinedload(Ticket.assigned_technician),
+                undefer_group('details')
+            )\
+            .filter(Customer.phone_number == phone)\
+            .order_by(Ticket.created_at.desc())\
+            .limit(limit).all()
     
-    def get_pending_tickets(self) -> List[Ticket]:
-        """Get all pending review tickets"""
-        return Ticket.query.filter_by(status=TicketStatus.PENDING_REVIEW.value)\
-            .order_by(Ticket.created_at.asc()).all()
+    def select_ticket_rows(self, status: Optional[str] = None, limit: int = 50):
+        """
+        Build a columns-only SELECT for ticket list responses
+        
+        Rows have the same keys as Ticket.to_dict() (dates are left as
+        date/datetime for the JSON encoder), so list endpoints can skip
+        ORM instance construction entirely.
+        
+        Args:
+            status: Optional status filter
+            limit: Maximum rows
+            
+        Returns:
+            SQLAlchemy Select; run it with .mappings()
+        """
+        stmt = select(
+            Ticket.id,
+            Ticket.ticket_number,
+            Ticket.customer_id,
+            Customer.phone_number.label('customer_phone'),
+            Customer.customer_name.label('customer_name'),
+            func.coalesce(Customer.has_kapci_account, False, type_=db.Boolean)
+                .label('customer_has_account'),
+            Ticket.product_name,
+            Ticket.product_sku,
+            Ticket.purchase_date,
+            Ticket.quantity,
+            Ticket.issue_description,
+            Ticket.issue_category,
+            Ticket.photos,
+            Ticket.status,
+            Ticket.priority,
+            Ticket.technical_decision,
+            Ticket.technical_notes,
+            Ticket.compensation_type,
+            Technician.name.label('assigned_technician'),
+            Ticket.created_at,
+            Ticket.updated_at
+        ).outerjoin(Customer, Ticket.customer_id == Customer.id)\
+            .outerjoin(Technician, Ticket.assigned_technician_id == Technician.id)
+        
+        if status:
+            stmt = stmt.where(Ticket.status == status)
+        
+        return stmt.order_by(Ticket.created_at.desc()).limit(limit)
+    
+    def get_tickets_by_status(self, status: str, after_id: Optional[int] = None,
+                              limit: int = 50) -> List[Ticket]:
+        """
+        Get a page of tickets with the given status, oldest first
+        
+        Args:
+            status: Ticket status
+            after_id: ID of the last ticket on the previous page
+            limit: Page size
+            
+        Returns:
+            Up to `limit` tickets following `after_id`
+        """
+        query = Ticket.query.options(*_ticket_relation_options()).filter_by(status=status)
+        if after_id:
+            # Keyset pagination on the (status, id) index: seek past the last
+            # row seen instead of skipping an OFFSET. IDs follow creation order
+            # and, unlike created_at, are unique.
+            query = query.filter(Ticket.id > after_id)
+        return query.order_by(Ticket.id.asc()).limit(limit).all()
+    
+    def get_pending_tickets(self, after_id: Optional[int] = None,
+                            limit: int = 50) -> List[Ticket]:
+        """Get a page of pending review tickets, oldest first (see get_tickets_by_status)"""
+        return self.get_tickets_by_status(TicketStatus.PENDING_REVIEW, after_id, limit)
     
     def get_technician_tickets(self, technician_id: int) -> List[Ticket]:
         """Get tickets assigned to a technician"""
-        return Ticket.query.filter_by(assigned_technician_id=technician_id)\
+        return Ticket.query.options(*_serialized_ticket_options())\
+            .filter_by(assigned_technician_id=technician_id)\
             .filter(Ticket.status.in_([
-                TicketStatus.PENDING_REVIEW.value,
-                TicketStatus.UNDER_REVIEW.value
+                TicketStatus.PENDING_REVIEW,
+                TicketStatus.UNDER_REVIEW
             ]))\
             .order_by(Ticket.created_at.asc()).all()
     
@@ -90,31 +249,34 @@ class TicketService:
         
         Args:
             ticket_id: Ticket ID
-            data: Update data
+            data: Update data (keys outside TICKET_WRITABLE_FIELDS are ignored)
             
         Returns:
             Updated ticket
         """
-        ticket = Ticket.query.get(ticket_id)
-        if not ticket:
+        # Only whitelisted columns; relationships, keys and workflow fields
+        # are never written from request data
+        values = {key: value for key, value in data.items() if key in TICKET_WRITABLE_FIELDS}
+        
+        result = db.session.execute(
+            update(Ticket)
+            .where(Ticket.id == ticket_id)
+            .values(**values, updated_at=_request_now())
+        )
+        if not result.rowcount:
             return None
         
-        for key, value in data.items():
-            if hasattr(ticket, key):
-                setattr(ticket, key, value)
+        self._commit()
         
-        ticket.updated_at = datetime.utcnow()
-        db.session.commit()
-        
-        return ticket
+        return db.session.get(Ticket, ticket_id)
     
-    def update_status(self, ticket_id: int, new_status: str, 
+    def update_status(self, ticket: Union[int, Ticket], new_status: str, 
                      changed_by: str = 'System', reason: str = None) -> Optional[Ticket]:
         """
         Update ticket status
         
         Args:
-            ticket_id: Ticket ID
+            ticket: Ticket or ticket ID
             new_status: New status
             changed_by: Who made the change
             reason: Reason for change
@@ -122,21 +284,22 @@ class TicketService:
         Returns:
             Updated ticket
         """
-        ticket = Ticket.query.get(ticket_id)
+        ticket = self._load_ticket(ticket)
         if not ticket:
             return None
         
+        now = _request_now()
         old_status = ticket.status
         ticket.status = new_status
-        ticket.updated_at = datetime.utcnow()
+        ticket.updated_at = now
         
-        if new_status == TicketStatus.COMPLETED.value:
-            ticket.completed_at = datetime.utcnow()
+        if new_status == TicketStatus.COMPLETED:
+            ticket.completed_at = now
         
-        db.session.commit()
+        # Log status change in the same commit
+        self._log_status_change(ticket.id, old_status, new_status, changed_by, reason)
         
-        # Log status change
-        self._log_status_change(ticket_id, old_status, new_status, changed_by, reason)
+        self._commit()
         
         return ticket
     
@@ -151,30 +314,57 @@ class TicketService:
         Returns:
             Updated ticket
         """
-        ticket = Ticket.query.get(ticket_id)
+        ticket = self._load_ticket(ticket_id)
         if not ticket:
             return None
         
-        if technician_id:
-            technician = Technician.query.get(technician_id)
-        else:
-            # Auto-assign to technician with lowest workload
-            technician = Technician.query.filter_by(is_active=True)\
-                .filter(Technician.current_workload < Technician.max_workload)\
-                .order_by(Technician.current_workload.asc())\
-                .first()
+        if self._assign_technician(ticket, technician_id):
+            self._commit()
         
+        return ticket
+    
+    def _assign_technician(self, ticket: Ticket, technician_id: int = None) -> Optional[Technician]:
+        """Assign an already-loaded ticket to a technician (no commit)"""
+        technician = self._pick_technician(technician_id)
         if technician:
-            ticket.assigned_technician_id = technician.id
-            technician.current_workload += 1
-            db.session.commit()
-            
-            self._log_status_change(
-                ticket_id, None, None, 'System',
-                f'Assigned to technician: {technician.name}'
+            self._record_assignment(ticket, technician)
+        return technician
+    
+    def _pick_technician(self, technician_id: int = None) -> Optional[Technician]:
+        """Get the requested technician, or the least-loaded available one"""
+        if technician_id:
+            return db.session.get(Technician, technician_id)
+        
+        # Auto-assign to technician with lowest workload. The row stays
+        # locked until the caller commits; concurrent assignments skip it
+        # and take the next technician instead of piling onto this one
+        # (ignored on SQLite, which serializes writers anyway)
+        return db.session.scalars(
+            select(Technician)
+            .where(
+                Technician.is_active.is_(True),
+                Technician.current_workload < Technician.max_workload
             )
+            .order_by(Technician.current_workload.asc())
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        ).first()
+    
+    def _record_assignment(self, ticket: Ticket, technician: Technician) -> None:
+        """Point the ticket at the technician, bump their workload and log it"""
+        ticket.assigned_technician_id = technician.id
+        # Increment in SQL so concurrent assignments can't lose an update
+        db.session.execute(
+            update(Technician)
+            .where(Technician.id == technician.id)
+            .values(current_workload=Technician.current_workload + 1)
+        )
         
-        return ticket
+        # Assignment keeps the status; history rows require new_status
+        self._log_status_change(
+            ticket.id, ticket.status, ticket.status, 'System',
+            f'Assigned to technician: {technician.name}'
+        )
     
     def record_technical_decision(self, ticket_id: int, decision: str,
                                   notes: str = None, technician_id: int = None) -> Optional[Ticket]:
@@ -190,215 +380,299 @@ class TicketService:
         Returns:
             Updated ticket
         """
-        ticket = Ticket.query.get(ticket_id)
+        # Technician and customer are both needed below; load them up front
+        ticket = db.session.get(Ticket, ticket_id, options=_ticket_relation_options())
         if not ticket:
             return None
         
         ticket.technical_decision = decision
         ticket.technical_notes = notes
-        ticket.technical_review_date = datetime.utcnow()
+        ticket.technical_review_date = _request_now()
         
-        # Update technician workload
+        # Update technician workload atomically, never below zero
         if ticket.assigned_technician:
-            ticket.assigned_technician.current_workload = max(
-                0, ticket.assigned_technician.current_workload - 1
+            db.session.execute(
+                update(Technician)
+                .where(Technician.id == ticket.assigned_technician_id)
+                .values(current_workload=case(
+                    (Technician.current_workload > 0, Technician.current_workload - 1),
+                    else_=0
+                ))
             )
         
-        if decision == TechnicalDecision.REJECTED.value:
-            ticket.status = TicketStatus.REJECTED.value
+        if decision == TechnicalDecision.REJECTED:
+            ticket.status = TicketStatus.REJECTED
             changed_by = ticket.assigned_technician.name if ticket.assigned_technician else 'Technical Team'
-            self._log_status_change(ticket_id, ticket.status, TicketStatus.REJECTED.value, 
+            self._log_status_change(ticket_id, ticket.status, TicketStatus.REJECTED, 
                                    changed_by, f'Rejected: {notes}')
         else:
             # Route to compensation
-            self.route_to_compensation(ticket_id)
+            self._route_to_compensation(ticket)
         
-        db.session.commit()
+        self._commit()
         return ticket
     
-    def route_to_compensation(self, ticket_id: int) -> Optional[Ticket]:
+    def route_to_compensation(self, ticket: Union[int, Ticket]) -> Optional[Ticket]:
         """
         Route approved ticket to appropriate compensation flow
         
         Args:
-            ticket_id: Ticket ID
+            ticket: Ticket or ticket ID
             
         Returns:
             Updated ticket
         """
-        ticket = Ticket.query.get(ticket_id)
+        ticket = self._load_ticket(ticket)
         if not ticket:
             return None
         
+        self._route_to_compensation(ticket)
+        
+        self._commit()
+        return ticket
+    
+    def _route_to_compensation(self, ticket: Ticket) -> None:
+        """Set compensation type and status on an already-loaded ticket (no commit)"""
         customer = ticket.customer
         
         if customer and customer.has_kapci_account:
             # Customer has account - route to finance for refund
-            ticket.compensation_type = CompensationType.REFUND.value
-            ticket.status = TicketStatus.PENDING_FINANCE.value
+            ticket.compensation_type = CompensationType.REFUND
+            ticket.status = TicketStatus.PENDING_FINANCE
             self._log_status_change(
-                ticket_id, TicketStatus.APPROVED.value, 
-                TicketStatus.PENDING_FINANCE.value,
+                ticket.id, TicketStatus.APPROVED, 
+                TicketStatus.PENDING_FINANCE,
                 'System', 'Routed to Finance for refund'
             )
         else:
             # No account - route to inventory for replacement
-            ticket.compensation_type = CompensationType.REPLACEMENT.value
-            ticket.status = TicketStatus.PENDING_INVENTORY.value
+            ticket.compensation_type = CompensationType.REPLACEMENT
+            ticket.status = TicketStatus.PENDING_INVENTORY
             self._log_status_change(
-                ticket_id, TicketStatus.APPROVED.value,
-                TicketStatus.PENDING_INVENTORY.value,
+                ticket.id, TicketStatus.APPROVED,
+                TicketStatus.PENDING_INVENTORY,
                 'System', 'Routed to Inventory for replacement'
             )
-        
-        db.session.commit()
-        return ticket
     
-    def process_finance_approval(self, ticket_id: int, sales_order: str = None) -> Optional[Ticket]:
+    def process_finance_approval(self, ticket: Union[int, Ticket], sales_order: str = None) -> Optional[Ticket]:
         """
         Process finance department approval
         
         Args:
-            ticket_id: Ticket ID
+            ticket: Ticket or ticket ID
             sales_order: Sales order number
             
         Returns:
             Updated ticket
         """
-        ticket = Ticket.query.get(ticket_id)
+        ticket = self._load_ticket(ticket)
         if not ticket:
             return None
         
         ticket.sales_order_number = sales_order
-        ticket.status = TicketStatus.FINANCE_APPROVED.value
+        ticket.status = TicketStatus.FINANCE_APPROVED
         
         self._log_status_change(
-            ticket_id, TicketStatus.PENDING_FINANCE.value,
-            TicketStatus.FINANCE_APPROVED.value,
+            ticket.id, TicketStatus.PENDING_FINANCE,
+            TicketStatus.FINANCE_APPROVED,
             'Finance Team', f'Sales order created: {sales_order}'
         )
         
-        db.session.commit()
+        self._commit()
         return ticket
     
-    def process_inventory_preparation(self, ticket_id: int, tracking: str = None) -> Optional[Ticket]:
+    def process_inventory_preparation(self, ticket: Union[int, Ticket], tracking: str = None) -> Optional[Ticket]:
         """
         Process inventory department preparation
         
         Args:
-            ticket_id: Ticket ID
+            ticket: Ticket or ticket ID
             tracking: Replacement tracking number
             
         Returns:
             Updated ticket
         """
-        ticket = Ticket.query.get(ticket_id)
+        ticket = self._load_ticket(ticket)
         if not ticket:
             return None
         
         ticket.replacement_tracking = tracking
-        ticket.status = TicketStatus.INVENTORY_PREPARED.value
+        ticket.status = TicketStatus.INVENTORY_PREPARED
         
         self._log_status_change(
-            ticket_id, TicketStatus.PENDING_INVENTORY.value,
-            TicketStatus.INVENTORY_PREPARED.value,
+            ticket.id, TicketStatus.PENDING_INVENTORY,
+            TicketStatus.INVENTORY_PREPARED,
             'Inventory Team', f'Replacement prepared. Tracking: {tracking}'
         )
         
-        db.session.commit()
+        self._commit()
         return ticket
     
-    def complete_ticket(self, ticket_id: int, completed_by: str = 'System') -> Optional[Ticket]:
+    def complete_ticket(self, ticket: Union[int, Ticket], completed_by: str = 'System') -> Optional[Ticket]:
         """
         Mark ticket as completed
         
         Args:
-            ticket_id: Ticket ID
+            ticket: Ticket or ticket ID
             completed_by: Who completed it
             
         Returns:
             Updated ticket
         """
-        ticket = Ticket.query.get(ticket_id)
+        ticket = self._load_ticket(ticket)
         if not ticket:
             return None
         
         old_status = ticket.status
-        ticket.status = TicketStatus.COMPLETED.value
-        ticket.completed_at = datetime.utcnow()
+        ticket.status = TicketStatus.COMPLETED
+        ticket.completed_at = _request_now()
         
-        self._log_status_change(ticket_id, old_status, TicketStatus.COMPLETED.value,
+        self._log_status_change(ticket.id, old_status, TicketStatus.COMPLETED,
                                completed_by, 'Ticket completed')
         
-        db.session.commit()
+        self._commit()
         return ticket
     
-    def get_overdue_tickets(self, days: int = 2) -> List[Ticket]:
+    def get_overdue_tickets(self, days: int = 2, limit: Optional[int] = None) -> List[Ticket]:
         """
         Get tickets that have exceeded review time
         
+        Served by a range scan on the (status, created_at) index per open
+        status; with a limit only the oldest `limit` rows are sorted and loaded.
+        
         Args:
             days: Number of days threshold
+            limit: Maximum number of tickets to return (None for all)
             
         Returns:
-            List of overdue tickets
+            List of overdue tickets, oldest first
         """
-        threshold = datetime.utcnow() - timedelta(days=days)
+        threshold = _request_now() - timedelta(days=days)
         
-        return Ticket.query.filter(
+        return Ticket.query.options(*_serialized_ticket_options()).filter(
             and_(
                 Ticket.status.in_([
-                    TicketStatus.PENDING_REVIEW.value,
-                    TicketStatus.UNDER_REVIEW.value
+                    TicketStatus.PENDING_REVIEW,
+                    TicketStatus.UNDER_REVIEW
                 ]),
                 Ticket.created_at < threshold
             )
-        ).order_by(Ticket.created_at.asc()).all()
+        ).order_by(Ticket.created_at.asc()).limit(limit).all()
     
     def get_statistics(self) -> Dict:
         """
         Get ticket statistics
         
+        Counts come from the ticket_counters rows; only new_this_week touches
+        the tickets table, as a range count on the created_at index.
+        
         Returns:
             Statistics dictionary
         """
-        total = Ticket.query.count()
-        pending = Ticket.query.filter_by(status=TicketStatus.PENDING_REVIEW.value).count()
-        approved = Ticket.query.filter(Ticket.technical_decision == TechnicalDecision.APPROVED.value).count()
-        rejected = Ticket.query.filter_by(status=TicketStatus.REJECTED.value).count()
-        completed = Ticket.query.filter_by(status=TicketStatus.COMPLETED.value).count()
+        week_ago = _request_now() - timedelta(days=7)
+        
+        counts = dict(db.session.execute(select(TicketCounter.key, TicketCounter.count)).all())
         
-        # This week
-        week_ago = datetime.utcnow() - timedelta(days=7)
-        new_this_week = Ticket.query.filter(Ticket.created_at >= week_ago).count()
+        def count(kind, value):
+            return counts.get(TicketCounter.counter_key(kind, value), 0)
+        
+        new_this_week = db.session.execute(
+            select(func.count()).select_from(Ticket).where(Ticket.created_at >= week_ago)
+        ).scalar()
         
         return {
-            'total': total,
-            'pending': pending,
-            'approved': approved,
-            'rejected': rejected,
-            'completed': completed,
+            'total': counts.get(TicketCounter.TOTAL, 0),
+            'pending': count('status', TicketStatus.PENDING_REVIEW),
+            'approved': count('decision', TechnicalDecision.APPROVED),
+            'rejected': count('status', TicketStatus.REJECTED),
+            'completed': count('status', TicketStatus.COMPLETED),
             'new_this_week': new_this_week,
-            'pending_finance': Ticket.query.filter_by(status=TicketStatus.PENDING_FINANCE.value).count(),
-            'pending_inventory': Ticket.query.filter_by(status=TicketStatus.PENDING_INVENTORY.value).count()
+            'pending_finance': count('status', TicketStatus.PENDING_FINANCE),
+            'pending_inventory': count('status', TicketStatus.PENDING_INVENTORY)
         }
     
+    def rebuild_counters(self) -> None:
+        """
+        Recompute ticket_counters from the tickets table
+        
+        Used to seed the counters for an existing database and to reconcile
+        them after tickets were changed outside the ORM.
+        """
+        # Zero rows for every known key, so later changes only ever UPDATE
+        # and concurrent first writes can't race to INSERT the same key
+        counts = dict.fromkeys(TicketCounter.all_keys(), 0)
+        counts[TicketCounter.TOTAL] = db.session.query(Ticket).count()
+        for kind, column in (('status', Ticket.status), ('decision', Ticket.technical_decision)):
+            counts.update(
+                (TicketCounter.counter_key(kind, value), n)
+                for value, n in db.session.execute(
+                    select(column, func.count()).where(column.is_not(None)).group_by(column)
+                )
+            )
+        
+        db.session.execute(TicketCounter.__table__.delete())
+        db.session.execute(
+            TicketCounter.__table__.insert(),
+            [{'key': key, 'count': n} for key, n in counts.items()]
+        )
+        db.session.commit()
+    
+    def ensure_counter_keys(self) -> None:
+        """Add zero rows for known counter keys missing from ticket_counters"""
+        existing = set(db.session.scalars(select(TicketCounter.key)))
+        missing = [key for key in TicketCounter.all_keys() if key not in existing]
+        if missing:
+            db.session.execute(
+                TicketCounter.__table__.insert(),
+                [{'key': key, 'count': 0} for key in missing]
+            )
+            db.session.commit()
+    
+    def _load_ticket(self, ticket: Union[int, Ticket]) -> Optional[Ticket]:
+        """Return the given ticket, loading it first when only an ID is passed"""
+        if isinstance(ticket, Ticket):
+            return ticket
+        return db.session.get(Ticket, ticket)
+    
     def _log_status_change(self, ticket_id: int, old_status: str, 
                           new_status: str, changed_by: str, reason: str = None):
-        """Log ticket status change"""
-        history = TicketStatusHistory(
-            ticket_id=ticket_id,
-            old_status=old_status,
-            new_status=new_status,
-            changed_by=changed_by,
-            reason=reason
-        )
-        db.session.add(history)
+        """
+        Queue a ticket status change for flush_history()
+        
+        Rows are kept on the session rather than the service, since the
+        service is a process-wide singleton shared by concurrent requests.
+        """
+        db.session.info.setdefault(PENDING_HISTORY_KEY, []).append({
+            'ticket_id': ticket_id,
+            'old_status': old_status,
+            'new_status': new_status,
+            'changed_by': changed_by,
+            'reason': reason
+        })
+    
+    def flush_history(self) -> int:
+        """
+        Write queued status history rows in a single executemany INSERT
+        
+        Returns:
+            Number of rows written
+        """
+        rows = db.session.info.pop(PENDING_HISTORY_KEY, None)
+        if not rows:
+            return 0
+        db.session.execute(TicketStatusHistory.__table__.insert(), rows)
+        return len(rows)
+    
+    def _commit(self):
+        """Flush queued history, then commit the transaction"""
+        self.flush_history()
+        db.session.commit()
     
     def get_status_history(self, ticket_id: int) -> List[TicketStatusHistory]:
         """Get ticket status history"""
         return TicketStatusHistory.query.filter_by(ticket_id=ticket_id)\
-            .order_by(TicketStatusHistory.created_at.asc()).all()
+            .order_by(TicketStatusHistory.created_at.asc(), TicketStatusHistory.id.asc())\
+            .all()
 
 
 # Singleton instance
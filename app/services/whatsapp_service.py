@@ -3,13 +3,59 @@ KAPCI WhatsApp AI Agent - WhatsApp Service
 WhatsApp Business API Integration
 """
 import requests
-import json
+import orjson
 import hashlib
 import hmac
-from typing import Dict, List, Optional
+import io
+import queue
+import threading
+from typing import BinaryIO, Dict, List, Optional
 from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 import os
 
+# Keep-alive pool to the Graph API, shared by direct and queued sends
+POOL_CONNECTIONS = 20
+POOL_MAXSIZE = 100
+
+# (connect, read) timeouts in seconds
+GRAPH_TIMEOUT = (3, 10)
+MEDIA_TIMEOUT = (3, 30)
+
+# Bytes copied per read when streaming media downloads
+MEDIA_CHUNK_SIZE = 64 * 1024
+
+# Pre-encoded bodies for the two sends on every message turn; only the
+# JSON-encoded variable fields are substituted in
+_TEXT_BODY = (b'{"messaging_product":"whatsapp","recipient_type":"individual",'
+              b'"to":%b,"type":"text","text":{"preview_url":false,"body":%b}}')
+_READ_BODY = b'{"messaging_product":"whatsapp","status":"read","message_id":%b}'
+
+
+def _build_session() -> requests.Session:
+    """
+    Build the pooled keep-alive session for Graph API calls
+    
+    Sends are POSTs, so besides connection failures only 429 responses are
+    retried: a rate-limited message was not accepted and cannot be sent twice.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=POOL_CONNECTIONS,
+        pool_maxsize=POOL_MAXSIZE,
+        max_retries=Retry(
+            total=3,
+            read=0,
+            backoff_factor=0.2,
+            status_forcelist=(429,),
+            allowed_methods=frozenset(['GET', 'POST'])
+        )
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
 
 class WhatsAppService:
     """WhatsApp Business API Service"""
@@ -20,6 +66,14 @@ class WhatsAppService:
         self.phone_number_id = None
         self.access_token = None
         self.verify_token = None
+        self.app_secret = None
+        
+        # All calls share one keep-alive session; queued sends are drained
+        # by one background thread
+        self.session = _build_session()
+        self._outbound = queue.SimpleQueue()
+        self._outbound_thread = None
+        self._outbound_lock = threading.Lock()
         
         if app:
             self.init_app(app)
@@ -30,6 +84,13 @@ class WhatsAppService:
         self.phone_number_id = app.config.get('WHATSAPP_PHONE_NUMBER_ID', '')
         self.access_token = app.config.get('WHATSAPP_ACCESS_TOKEN', '')
         self.verify_token = app.config.get('WHATSAPP_VERIFY_TOKEN', 'kapci_verify_token')
+        self.app_secret = app.config.get('WHATSAPP_APP_SECRET', '')
+        
+        # Auth headers are set once on the session rather than per call
+        self.session.headers.update({
+            'Authorization': f'Bearer {self.access_token}',
+            'Content-Type': 'application/json'
+        })
     
     def verify_webhook(self, mode: str, token: str, challenge: str) -> Optional[str]:
         """
@@ -43,10 +104,33 @@ class WhatsAppService:
         Returns:
             Challenge string if valid, None otherwise
         """
-        if mode == 'subscribe' and token == self.verify_token:
+        if mode != 'subscribe' or not self.verify_token:
+            return None
+        if hmac.compare_digest((token or '').encode(), self.verify_token.encode()):
             return challenge
         return None
     
+    def verify_signature(self, body: bytes, signature: Optional[str]) -> bool:
+        """
+        Check a webhook body against its X-Hub-Signature-256 header
+        
+        Runs on the raw bytes before any JSON parsing, so forged payloads are
+        rejected cheaply. Always passes when no app secret is configured.
+        
+        Args:
+            body: Raw request body
+            signature: X-Hub-Signature-256 header value ('sha256=<hex>')
+            
+        Returns:
+            True if the signature is valid or verification is disabled
+        """
+        if not self.app_secret:
+            return True
+        if not signature or not signature.startswith('sha256='):
+            return False
+        expected = hmac.new(self.app_secret.encode(), body, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(signature[len('sha256='):].encode(), expected.encode())
+    
     def parse_incoming_message(self, payload: Dict) -> Optional[Dict]:
         """
         Parse incoming webhook payload from WhatsApp
@@ -125,25 +209,9 @@ class WhatsAppService:
         """
         url = f"{self.api_url}/{self.phone_number_id}/messages"
         
-        headers = {
-            'Authorization': f'Bearer {self.access_token}',
-            'Content-Type': 'application/json'
-        }
-        
-        payload = {
-            'messaging_product': 'whatsapp',
-            'recipient_type': 'individual',
-            'to': to,
-            'type': 'text',
-            'text': {
-                'preview_url': False,
-                'body': text
-            }
-        }
-        
         try:
-            response = requests.post(url, headers=headers, json=payload)
-            return response.json()
+            response = self.session.post(url, data=self._text_body(to, text), timeout=GRAPH_TIMEOUT)
+            return orjson.loads(response.content)
         except Exception as e:
             print(f"Error sending message: {e}")
             return {'error': str(e)}
@@ -165,11 +233,6 @@ class WhatsAppService:
         """
         url = f"{self.api_url}/{self.phone_number_id}/messages"
         
-        headers = {
-            'Authorization': f'Bearer {self.access_token}',
-            'Content-Type': 'application/json'
-        }
-        
         payload = {
             'messaging_product': 'whatsapp',
             'to': to,
@@ -186,8 +249,8 @@ class WhatsAppService:
             payload['template']['components'] = components
         
         try:
-            response = requests.post(url, headers=headers, json=payload)
-            return response.json()
+            response = self.session.post(url, data=orjson.dumps(payload), timeout=GRAPH_TIMEOUT)
+            return orjson.loads(response.content)
         except Exception as e:
             print(f"Error sending template: {e}")
             return {'error': str(e)}
@@ -211,11 +274,6 @@ class WhatsAppService:
         """
         url = f"{self.api_url}/{self.phone_number_id}/messages"
         
-        headers = {
-            'Authorization': f'Bearer {self.access_token}',
-            'Content-Type': 'application/json'
-        }
-        
         interactive = {
             'type': 'button',
             'body': {
@@ -248,8 +306,8 @@ class WhatsAppService:
         }
         
         try:
-            response = requests.post(url, headers=headers, json=payload)
-            return response.json()
+            response = self.session.post(url, data=orjson.dumps(payload), timeout=GRAPH_TIMEOUT)
+            return orjson.loads(response.content)
         except Exception as e:
             print(f"Error sending interactive: {e}")
             return {'error': str(e)}
@@ -275,11 +333,6 @@ class WhatsAppService:
         """
         url = f"{self.api_url}/{self.phone_number_id}/messages"
         
-        headers = {
-            'Authorization': f'Bearer {self.access_token}',
-            'Content-Type': 'application/json'
-        }
-        
         interactive = {
             'type': 'list',
             'body': {
@@ -305,15 +358,17 @@ class WhatsAppService:
         }
         
         try:
-            response = requests.post(url, headers=headers, json=payload)
-            return response.json()
+            response = self.session.post(url, data=orjson.dumps(payload), timeout=GRAPH_TIMEOUT)
+            return orjson.loads(response.content)
         except Exception as e:
             print(f"Error sending list: {e}")
             return {'error': str(e)}
     
     def download_media(self, media_id: str) -> Optional[bytes]:
         """
-        Download media file from WhatsApp
+        Download media file from WhatsApp into memory
+        
+        Prefer stream_media() when the file is written somewhere anyway.
         
         Args:
             media_id: Media ID
@@ -321,22 +376,43 @@ class WhatsAppService:
         Returns:
             Media bytes or None
         """
+        buffer = io.BytesIO()
+        if self.stream_media(media_id, buffer):
+            return buffer.getvalue()
+        return None
+    
+    def stream_media(self, media_id: str, sink: BinaryIO) -> bool:
+        """
+        Stream a WhatsApp media file into a writable binary file object
+        
+        The file is copied in MEDIA_CHUNK_SIZE pieces, so memory use does not
+        grow with the media size.
+        
+        Args:
+            media_id: Media ID
+            sink: Open binary file, BytesIO or any object with write()
+            
+        Returns:
+            True if the media was written to sink
+        """
         # First get media URL
         url = f"{self.api_url}/{media_id}"
-        headers = {'Authorization': f'Bearer {self.access_token}'}
         
         try:
-            response = requests.get(url, headers=headers)
-            media_url = response.json().get('url')
+            response = self.session.get(url, timeout=GRAPH_TIMEOUT)
+            media_url = orjson.loads(response.content).get('url')
             
             if media_url:
-                # Download the actual media
-                media_response = requests.get(media_url, headers=headers)
-                return media_response.content
+                # Download the actual media (the media host also wants the token)
+                with self.session.get(media_url, timeout=MEDIA_TIMEOUT, stream=True) as media_response:
+                    media_response.raise_for_status()
+                    for chunk in media_response.iter_content(chunk_size=MEDIA_CHUNK_SIZE):
+                        sink.write(chunk)
+                return True
         except Exception as e:
             print(f"Error downloading media: {e}")
         
-        return None
+        return False
     
     def mark_as_read(self, message_id: str) -> Dict:
         """
@@ -350,23 +426,64 @@ class WhatsAppService:
         """
         url = f"{self.api_url}/{self.phone_number_id}/messages"
         
-        headers = {
-            'Authorization': f'Bearer {self.access_token}',
-            'Content-Type': 'application/json'
-        }
-        
-        payload = {
-            'messaging_product': 'whatsapp',
-            'status': 'read',
-            'message_id': message_id
-        }
-        
         try:
-            response = requests.post(url, headers=headers, json=payload)
-            return response.json()
+            response = self.session.post(url, data=self._read_body(message_id), timeout=GRAPH_TIMEOUT)
+            return orjson.loads(response.content)
         except Exception as e:
             return {'error': str(e)}
 
+    
+    # ==========================================
+    # QUEUED OUTBOUND MESSAGES
+    # ==========================================
+    
+    def enqueue_text_message(self, to: str, text: str):
+        """
+        Queue a text message for background sending
+        
+        Args:
+            to: Recipient phone number
+            text: Message text
+        """
+        self._outbound.put((self._text_body(to, text), 'text'))
+        self._ensure_outbound_worker()
+    
+    def enqueue_mark_as_read(self, message_id: str):
+        """Queue a read receipt for background sending"""
+        self._outbound.put((self._read_body(message_id), 'read'))
+        self._ensure_outbound_worker()
+    
+    def _ensure_outbound_worker(self):
+        """Start the outbound worker thread if it is not running"""
+        with self._outbound_lock:
+            if self._outbound_thread is None or not self._outbound_thread.is_alive():
+                self._outbound_thread = threading.Thread(
+                    target=self._drain_outbound, daemon=True
+                )
+                self._outbound_thread.start()
+    
+    def _drain_outbound(self):
+        """Send queued bodies one by one as soon as they are dequeued"""
+        # The Cloud API takes one message per POST, so there is nothing to
+        # batch; the gain is the kept-alive session and not blocking callers
+        while True:
+            body, kind = self._outbound.get()
+            url = f"{self.api_url}/{self.phone_number_id}/messages"
+            try:
+                self.session.post(url, data=body, timeout=GRAPH_TIMEOUT)
+            except Exception as e:
+                print(f"Error sending queued {kind}: {e}")
+    
+    @staticmethod
+    def _text_body(to: str, text: str) -> bytes:
+        """Encode a text message request body"""
+        return _TEXT_BODY % (orjson.dumps(to), orjson.dumps(text))
+    
+    @staticmethod
+    def _read_body(message_id: str) -> bytes:
+        """Encode a mark-as-read request body"""
+        return _READ_BODY % orjson.dumps(message_id)
+
 
 # Singleton instance
 whatsapp_service = WhatsAppService()
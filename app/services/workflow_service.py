@@ -2,13 +2,17 @@
 KAPCI WhatsApp AI Agent - Workflow Service
 Main Conversation Orchestrator and State Machine
 """
-from datetime import datetime
 from typing import Dict, Optional, Tuple
 import json
+import os
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 
+from app.extensions import cache, STATS_CACHE_KEY
 from app.models import (
     db, Customer, Ticket, Conversation, ConversationState,
-    ConversationStep, TicketStatus
+    ConversationStep, TicketStatus, utcnow
 )
 from app.services.ai_service import ai_service
 from app.services.ticket_service import ticket_service
@@ -21,6 +25,44 @@ class WorkflowService:
     
     def __init__(self):
         self.templates = MessageTemplates()
+        
+        # Conversation step -> handler; other steps go to _handle_other_step
+        self._step_handlers = {
+            ConversationStep.IDLE: self._handle_idle,
+            ConversationStep.COLLECTING_PRODUCT: self._handle_collecting_product,
+            ConversationStep.COLLECTING_ISSUE: self._handle_collecting_issue,
+            ConversationStep.COLLECTING_PHOTOS: self._handle_collecting_photos,
+            ConversationStep.CONFIRMING_DATA: self._handle_confirming_data
+        }
+    
+    def process_incoming(self, parsed: Dict, send_now: bool = False):
+        """
+        Handle a parsed webhook message and send or queue the reply
+        
+        Args:
+            parsed: Message from WhatsAppService.parse_incoming_message
+            send_now: Send the reply and read receipt before returning
+                instead of handing them to the in-process outbound worker
+        """
+        response = self.handle_incoming_message(
+            phone=parsed['from'],
+            message=parsed.get('content', ''),
+            message_type=parsed.get('type', 'text'),
+            media_id=parsed.get('media_id'),
+            contact_name=parsed.get('contact_name')
+        )
+        
+        if send_now:
+            whatsapp_service.send_text_message(parsed['from'], response)
+            if parsed.get('message_id'):
+                whatsapp_service.mark_as_read(parsed['message_id'])
+            return
+        
+        # Queue response and read receipt for the outbound worker
+        whatsapp_service.enqueue_text_message(parsed['from'], response)
+        
+        if parsed.get('message_id'):
+            whatsapp_service.enqueue_mark_as_read(parsed['message_id'])
     
     def handle_incoming_message(self, phone: str, message: str, 
                                message_type: str = 'text',
@@ -39,35 +81,35 @@ class WorkflowService:
         Returns:
             Response message to send
         """
-        # Get or create customer
+        # Get or create customer (its conversation state comes in the same query)
         customer = self._get_or_create_customer(phone, contact_name)
         
         # Get or create conversation state
-        state = self._get_conversation_state(customer.id)
+        state = self._get_conversation_state(customer)
         
-        # Save incoming message
-        self._save_message(customer.id, 'inbound', message, message_type)
+        # Build the incoming message; it is added with the reply below
+        inbound = self._build_message(customer.id, 'inbound', message, message_type)
+        
+        # Detect language, classify intent and extract entities in one pass
+        analysis = ai_service.analyze(message, state.current_step)
+        language = analysis['language']
+        intent = analysis['intent']
+        entities = analysis['entities']
         
-        # Detect language
-        language = ai_service.detect_language(message)
         if language != customer.preferred_language:
             customer.preferred_language = language
-            db.session.commit()
-        
-        # Classify intent
-        intent = ai_service.classify_intent(message, state.current_step)
-        
-        # Extract entities
-        entities = ai_service.extract_entities(message)
         
         # Route and process message
         response = self._route_message(customer, state, intent, message, entities, message_type, media_id)
         
-        # Save outgoing message
-        self._save_message(customer.id, 'outbound', response)
+        # Save both messages together so they go out in one INSERT batch
+        outbound = self._build_message(customer.id, 'outbound', response)
+        db.session.add_all([inbound, outbound])
         
-        # Update last message timestamp
-        state.last_message_at = datetime.utcnow()
+        # Update last message timestamp from the database clock, so every
+        # web and worker process stamps turns on the same clock; everything
+        # this turn changed (customer, state, both messages) lands in this one commit
+        state.last_message_at = utcnow()
         db.session.commit()
         
         return response
@@ -75,123 +117,137 @@ class WorkflowService:
     def _route_message(self, customer: Customer, state: ConversationState,
                       intent: str, message: str, entities: Dict,
                       message_type: str = 'text', media_id: str = None) -> str:
-        """Route message based on state and intent"""
+        """Route message to the handler for the conversation's current step"""
+        handler = self._step_handlers.get(state.current_step, self._handle_other_step)
+        return handler(customer, state, intent, message, entities, message_type, media_id)
+    
+    @staticmethod
+    def _collected_data(state: ConversationState) -> Dict:
+        """
+        Copy of the data collected so far
         
-        current_step = state.current_step
-        collected_data = state.collected_data or {}
+        Handlers work on a copy: reassigning the same (mutated) dict would not
+        mark the JSON column dirty and the collected data would never be saved.
+        """
+        return dict(state.collected_data or {})
+    
+    # =========================================
+    # IDLE STATE
+    # =========================================
+    
+    def _handle_idle(self, customer: Customer, state: ConversationState, intent: str,
+                     message: str, entities: Dict, message_type: str, media_id: str) -> str:
         lang = customer.preferred_language
         
-        # =========================================
-        # IDLE STATE
-        # =========================================
-        if current_step == ConversationStep.IDLE.value:
-            if intent == 'greeting':
-                return self.templates.get_greeting(lang)
-            
-            elif intent == 'new_complaint':
-                state.current_step = ConversationStep.COLLECTING_PRODUCT.value
-                state.collected_data = {}
-                db.session.commit()
-                return self.templates.get_ask_product(lang)
-            
-            elif intent == 'check_status':
-                return self._handle_status_check(customer, entities, lang)
-            
-            elif intent == 'help':
-                return self.templates.get_help(lang)
-            
-            elif intent == 'thanks':
-                return self.templates.get_thanks_response(lang)
-            
-            else:
-                return self.templates.get_greeting(lang)
-        
-        # =========================================
-        # COLLECTING PRODUCT INFO
-        # =========================================
-        elif current_step == ConversationStep.COLLECTING_PRODUCT.value:
-            collected_data['product_name'] = message
-            state.collected_data = collected_data
-            state.current_step = ConversationStep.COLLECTING_ISSUE.value
-            db.session.commit()
-            return self.templates.get_ask_issue(lang)
-        
-        # =========================================
-        # COLLECTING ISSUE DESCRIPTION
-        # =========================================
-        elif current_step == ConversationStep.COLLECTING_ISSUE.value:
-            collected_data['issue_description'] = message
-            collected_data['issue_category'] = ai_service.suggest_issue_category(message)
-            state.collected_data = collected_data
-            state.current_step = ConversationStep.COLLECTING_PHOTOS.value
-            db.session.commit()
-            return self.templates.get_ask_photos(lang)
-        
-        # =========================================
-        # COLLECTING PHOTOS
-        # =========================================
-        elif current_step == ConversationStep.COLLECTING_PHOTOS.value:
-            if intent == 'skip':
-                collected_data['photos'] = []
-            elif message_type == 'image' and media_id:
-                photos = collected_data.get('photos', [])
-                photos.append(media_id)
-                collected_data['photos'] = photos
-            else:
-                collected_data['photos'] = []
-            
-            state.collected_data = collected_data
-            state.current_step = ConversationStep.CONFIRMING_DATA.value
-            db.session.commit()
-            
-            return self.templates.get_confirm_data(
-                collected_data.get('product_name', '-'),
-                collected_data.get('issue_description', '-'),
-                lang
-            )
+        if intent == 'new_complaint':
+            state.current_step = ConversationStep.COLLECTING_PRODUCT
+            state.collected_data = {}
+            return self.templates.get_ask_product(lang)
+        
+        elif intent == 'check_status':
+            return self._handle_status_check(customer, entities, lang)
+        
+        elif intent == 'help':
+            return self.templates.get_help(lang)
         
-        # =========================================
-        # CONFIRMING DATA
-        # =========================================
-        elif current_step == ConversationStep.CONFIRMING_DATA.value:
-            if intent == 'confirm_yes':
-                # Create ticket
-                ticket = ticket_service.create_ticket(customer.id, {
-                    'product_name': collected_data.get('product_name'),
-                    'issue_description': collected_data.get('issue_description'),
-                    'issue_category': collected_data.get('issue_category'),
-                    'photos': collected_data.get('photos', [])
-                })
-                
-                # Reset state
-                state.current_step = ConversationStep.IDLE.value
-                state.collected_data = {}
-                state.current_ticket_id = ticket.id
-                db.session.commit()
-                
-                return self.templates.get_ticket_created(ticket.ticket_number, lang)
+        elif intent == 'thanks':
+            return self.templates.get_thanks_response(lang)
+        
+        # Greetings and anything unrecognised get the menu
+        return self.templates.get_greeting(lang)
+    
+    # =========================================
+    # COLLECTING PRODUCT INFO
+    # =========================================
+    
+    def _handle_collecting_product(self, customer: Customer, state: ConversationState, intent: str,
+                                   message: str, entities: Dict, message_type: str, media_id: str) -> str:
+        collected_data = self._collected_data(state)
+        collected_data['product_name'] = message
+        state.collected_data = collected_data
+        state.current_step = ConversationStep.COLLECTING_ISSUE
+        return self.templates.get_ask_issue(customer.preferred_language)
+    
+    # =========================================
+    # COLLECTING ISSUE DESCRIPTION
+    # =========================================
+    
+    def _handle_collecting_issue(self, customer: Customer, state: ConversationState, intent: str,
+                                 message: str, entities: Dict, message_type: str, media_id: str) -> str:
+        collected_data = self._collected_data(state)
+        collected_data['issue_description'] = message
+        collected_data['issue_category'] = ai_service.suggest_issue_category(message)
+        state.collected_data = collected_data
+        state.current_step = ConversationStep.COLLECTING_PHOTOS
+        return self.templates.get_ask_photos(customer.preferred_language)
+    
+    # =========================================
+    # COLLECTING PHOTOS
+    # =========================================
+    
+    def _handle_collecting_photos(self, customer: Customer, state: ConversationState, intent: str,
+                                  message: str, entities: Dict, message_type: str, media_id: str) -> str:
+        collected_data = self._collected_data(state)
+        
+        if intent != 'skip' and message_type == 'image' and media_id:
+            collected_data['photos'] = collected_data.get('photos', []) + [media_id]
+        else:
+            collected_data['photos'] = []
+        
+        state.collected_data = collected_data
+        state.current_step = ConversationStep.CONFIRMING_DATA
+        
+        return self.templates.get_confirm_data(
+            collected_data.get('product_name', '-'),
+            collected_data.get('issue_description', '-'),
+            customer.preferred_language
+        )
+    
+    # =========================================
+    # CONFIRMING DATA
+    # =========================================
+    
+    def _handle_confirming_data(self, customer: Customer, state: ConversationState, intent: str,
+                                message: str, entities: Dict, message_type: str, media_id: str) -> str:
+        lang = customer.preferred_language
+        
+        if intent == 'confirm_yes':
+            # Create ticket
+            collected_data = state.collected_data or {}
+            ticket = ticket_service.create_ticket(customer.id, {
+                'product_name': collected_data.get('product_name'),
+                'issue_description': collected_data.get('issue_description'),
+                'issue_category': collected_data.get('issue_category'),
+                'photos': collected_data.get('photos', [])
+            })
             
-            elif intent == 'confirm_no':
-                # Restart collection
-                state.current_step = ConversationStep.COLLECTING_PRODUCT.value
-                state.collected_data = {}
-                db.session.commit()
-                return self.templates.get_restart(lang) + "\n\n" + self.templates.get_ask_product(lang)
+            # Reset state
+            state.current_step = ConversationStep.IDLE
+            state.collected_data = {}
+            state.current_ticket_id = ticket.id
             
-            else:
-                return self.templates.get_confirm_prompt(lang)
+            return self.templates.get_ticket_created(ticket.ticket_number, lang)
+        
+        elif intent == 'confirm_no':
+            # Restart collection
+            state.current_step = ConversationStep.COLLECTING_PRODUCT
+            state.collected_data = {}
+            return self.templates.get_restart(lang) + "\n\n" + self.templates.get_ask_product(lang)
+        
+        return self.templates.get_confirm_prompt(lang)
+    
+    # =========================================
+    # OTHER STEPS: CANCEL / DEFAULT
+    # =========================================
+    
+    def _handle_other_step(self, customer: Customer, state: ConversationState, intent: str,
+                           message: str, entities: Dict, message_type: str, media_id: str) -> str:
+        lang = customer.preferred_language
         
-        # =========================================
-        # CANCEL
-        # =========================================
         if intent == 'cancel':
             state.reset()
-            db.session.commit()
             return self.templates.get_cancelled(lang)
         
-        # =========================================
-        # DEFAULT
-        # =========================================
         return self.templates.get_unknown(lang)
     
     def _handle_status_check(self, customer: Customer, entities: Dict, lang: str) -> str:
@@ -231,6 +287,9 @@ class WorkflowService:
         if not ticket:
             return False, "Ticket not found"
         
+        # Dashboard counts changed with this decision
+        cache.delete(STATS_CACHE_KEY)
+        
         customer = ticket.customer
         lang = customer.preferred_language if customer else 'ar'
         
@@ -244,16 +303,15 @@ class WorkflowService:
             else:
                 notification = self.templates.get_ticket_approved_replacement(ticket.ticket_number, lang)
         
-        # Send WhatsApp notification (if configured)
+        # Queue the WhatsApp notification; the outbound worker sends it so
+        # this request doesn't wait on the Graph API
         if customer and customer.phone_number:
-            try:
-                whatsapp_service.send_text_message(customer.phone_number, notification)
-            except:
-                pass  # Log error but don't fail
+            whatsapp_service.enqueue_text_message(customer.phone_number, notification)
         
         # Save notification as message
         if customer:
             self._save_message(customer.id, 'outbound', notification)
+            db.session.commit()
         
         return True, notification
     
@@ -278,62 +336,79 @@ class WorkflowService:
         message = self.templates.get_reminder(ticket.ticket_number, reminder_type, lang)
         
         if customer.phone_number:
-            try:
-                whatsapp_service.send_text_message(customer.phone_number, message)
-                self._save_message(customer.id, 'outbound', message)
-                return True
-            except:
-                return False
+            whatsapp_service.enqueue_text_message(customer.phone_number, message)
+            self._save_message(customer.id, 'outbound', message)
+            db.session.commit()
+            return True
         
         return False
     
     def _get_or_create_customer(self, phone: str, name: str = None) -> Customer:
-        """Get existing customer or create new one"""
-        customer = Customer.query.filter_by(phone_number=phone).first()
+        """Get existing customer, with conversation state joined in, or create new one"""
+        customer = self._find_customer(phone)
         
         if not customer:
-            # For demo, randomly assign account status
-            import random
+            # Demo deployments randomly assign account status; otherwise new
+            # customers start without a KAPCI account
+            demo = current_app.config.get('DEMO_MODE', False)
             customer = Customer(
                 phone_number=phone,
                 customer_name=name,
-                has_kapci_account=random.choice([True, False]),
+                has_kapci_account=demo and bool(os.urandom(1)[0] & 1),
                 preferred_language='ar'
             )
-            db.session.add(customer)
-            db.session.commit()
-        elif name and not customer.customer_name:
+            # Insert in a savepoint (which also assigns the id): when a
+            # concurrent webhook from the same new number wins the race, the
+            # unique phone constraint fails only this insert and its row is used
+            try:
+                with db.session.begin_nested():
+                    db.session.add(customer)
+            except IntegrityError:
+                customer = self._find_customer(phone)
+        
+        if name and not customer.customer_name:
             customer.customer_name = name
-            db.session.commit()
         
         return customer
     
-    def _get_conversation_state(self, customer_id: int) -> ConversationState:
+    def _find_customer(self, phone: str) -> Optional[Customer]:
+        """Get customer by phone with the conversation state loaded in the same query"""
+        return Customer.query.options(joinedload(Customer.conversation_state))\
+            .filter_by(phone_number=phone).first()
+    
+    def _get_conversation_state(self, customer: Customer) -> ConversationState:
         """Get or create conversation state"""
-        state = ConversationState.query.filter_by(customer_id=customer_id).first()
+        state = customer.conversation_state
         
         if not state:
             state = ConversationState(
-                customer_id=customer_id,
-                current_step=ConversationStep.IDLE.value,
+                customer_id=customer.id,
+                current_step=ConversationStep.IDLE,
                 collected_data={}
             )
-            db.session.add(state)
-            db.session.commit()
+            # Same race as for customers: customer_id is unique
+            try:
+                with db.session.begin_nested():
+                    customer.conversation_state = state
+            except IntegrityError:
+                state = ConversationState.query.filter_by(customer_id=customer.id).one()
         
         return state
     
-    def _save_message(self, customer_id: int, direction: str, 
-                     content: str, message_type: str = 'text'):
-        """Save message to conversation history"""
-        message = Conversation(
+    def _build_message(self, customer_id: int, direction: str, 
+                       content: str, message_type: str = 'text') -> Conversation:
+        """Build a conversation history row without adding it to the session"""
+        return Conversation(
             customer_id=customer_id,
             direction=direction,
             content=content,
             message_type=message_type
         )
-        db.session.add(message)
-        db.session.commit()
+    
+    def _save_message(self, customer_id: int, direction: str, 
+                     content: str, message_type: str = 'text'):
+        """Add a message to conversation history (committed by the caller)"""
+        db.session.add(self._build_message(customer_id, direction, content, message_type))
 
 
 # Singleton instance
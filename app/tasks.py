@@ -0,0 +1,55 @@
+"""
+KAPCI WhatsApp AI Agent - Background Tasks
+Celery integration for processing WhatsApp webhooks off the web workers
+
+Only imported when CELERY_BROKER_URL is configured. Run a worker with:
+
+    celery -A run.celery_app worker -Q whatsapp_inbound
+"""
+from typing import Dict
+from celery import Celery, Task, shared_task
+
+# Queue for inbound webhook processing
+INBOUND_QUEUE = 'whatsapp_inbound'
+
+
+def celery_init_app(app) -> Celery:
+    """
+    Create the Celery app bound to a Flask app
+    
+    Every task runs inside the Flask app context, so services and the
+    database session work exactly as they do in a request.
+    """
+    class FlaskTask(Task):
+        def __call__(self, *args, **kwargs):
+            with app.app_context():
+                return self.run(*args, **kwargs)
+    
+    celery_app = Celery(app.name, task_cls=FlaskTask)
+    celery_app.conf.update(
+        broker_url=app.config['CELERY_BROKER_URL'],
+        task_ignore_result=True,
+        task_acks_late=True,
+        worker_prefetch_multiplier=1,
+        task_serializer='json',
+        accept_content=['json'],
+        task_routes={'app.tasks.process_incoming': {'queue': INBOUND_QUEUE}}
+    )
+    celery_app.set_default()
+    app.extensions['celery'] = celery_app
+    
+    # Workers never see a request, so configure WhatsApp sending here
+    from app.services.whatsapp_service import whatsapp_service
+    whatsapp_service.init_app(app)
+    
+    return celery_app
+
+
+@shared_task
+def process_incoming(parsed: Dict):
+    """Run the conversation workflow for a parsed webhook message"""
+    from app.services.workflow_service import workflow_service
+    # Send before returning: with acks_late the message is only acked once
+    # the reply has been posted, not when it sits in an in-process queue
+    # that a worker restart would drop
+    workflow_service.process_incoming(parsed, send_now=True)
@@ -3,19 +3,38 @@ KAPCI WhatsApp AI Agent - Utility Functions
 """
 import re
 import os
-import uuid
+import random
+import time
+import secrets
 import hashlib
-from datetime import datetime, timedelta
-from typing import Optional
-from functools import wraps
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Tuple, Type
+from functools import lru_cache, wraps
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Patterns compiled once at import; these run on every inbound message
+_NON_DIGITS = re.compile(r'\D')
+_EGYPT_PHONE = re.compile(r'^(\+?20|0)?1[0125]\d{8}$')
+_ARABIC = re.compile(r'[\u0600-\u06FF]')
+_TICKET_NUMBER = re.compile(r'^TKT-\d{4}-\d{5}$')
 
+# Date shapes accepted by parse_date: year first (groups 1-4) or year last
+# (groups 5-8), with '-' or '/' used consistently. Accepts exactly what
+# strptime did: any Unicode digits in the year, ASCII month and day, a single
+# space before a one-digit day (strptime's ' [1-9]' for %d), and no trailing
+# newline.
+_DATE_RE = re.compile(
+    r'^(?:(\d{4})([-/])([0-9]{1,2})\2( [1-9]|[0-9]{1,2})'
+    r'|( [1-9]|[0-9]{1,2})([-/])([0-9]{1,2})\6(\d{4}))\Z'
+)
+
+
+@lru_cache(maxsize=1024)
 def normalize_phone(phone: str) -> str:
     """Normalize phone number to standard format"""
-    digits = re.sub(r'\D', '', phone)
+    digits = _NON_DIGITS.sub('', phone)
     if digits.startswith('20'):
         return f'+{digits}'
     elif digits.startswith('0'):
@@ -25,22 +44,30 @@ def normalize_phone(phone: str) -> str:
     return f'+{digits}' if not phone.startswith('+') else phone
 
 
+@lru_cache(maxsize=1024)
 def validate_egypt_phone(phone: str) -> bool:
     """Validate Egyptian phone number"""
-    pattern = r'^(\+?20|0)?1[0125]\d{8}$'
-    normalized = re.sub(r'\D', '', phone)
-    return bool(re.match(pattern, normalized))
+    normalized = _NON_DIGITS.sub('', phone)
+    return bool(_EGYPT_PHONE.match(normalized))
 
 
 def parse_date(date_str: str) -> Optional[datetime]:
     """Parse date string in various formats"""
-    formats = ['%Y-%m-%d', '%d-%m-%Y', '%d/%m/%Y', '%Y/%m/%d']
-    for fmt in formats:
-        try:
-            return datetime.strptime(date_str, fmt)
-        except ValueError:
-            continue
-    return None
+    match = _DATE_RE.match(date_str)
+    if not match:
+        return None
+    
+    if match.group(1):
+        year, _, month, day = match.group(1, 2, 3, 4)
+    else:
+        day, _, month, year = match.group(5, 6, 7, 8)
+    
+    # Build the date directly; no strptime format parsing needed
+    try:
+        return datetime(int(year), int(month), int(day))
+    except ValueError:
+        # Right shape but not a real date (e.g. 31/02/2024)
+        return None
 
 
 def truncate(text: str, length: int = 100) -> str:
@@ -52,12 +79,12 @@ def truncate(text: str, length: int = 100) -> str:
 
 def contains_arabic(text: str) -> bool:
     """Check if text contains Arabic characters"""
-    return bool(re.search(r'[\u0600-\u06FF]', text))
+    return bool(_ARABIC.search(text))
 
 
 def generate_token(length: int = 32) -> str:
-    """Generate random secure token"""
-    return uuid.uuid4().hex[:length]
+    """Generate random secure token of `length` hex characters"""
+    return secrets.token_hex((length + 1) // 2)[:length]
 
 
 def mask_phone(phone: str) -> str:
@@ -69,7 +96,7 @@ def mask_phone(phone: str) -> str:
 
 def validate_ticket_number(ticket_number: str) -> bool:
     """Validate ticket number format"""
-    return bool(re.match(r'^TKT-\d{4}-\d{5}$', ticket_number))
+    return bool(_TICKET_NUMBER.match(ticket_number))
 
 
 def calculate_sla_deadline(created_at: datetime, hours: int = 48) -> datetime:
@@ -79,23 +106,29 @@ def calculate_sla_deadline(created_at: datetime, hours: int = 48) -> datetime:
 
 def is_sla_breached(created_at: datetime, hours: int = 48) -> bool:
     """Check if SLA has been breached"""
-    return datetime.utcnow() > calculate_sla_deadline(created_at, hours)
-
-
-def retry(max_attempts: int = 3, delay: float = 1.0):
-    """Retry decorator for functions that may fail"""
+    # Naive UTC, matching stored timestamps, without the deprecated utcnow()
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return now > calculate_sla_deadline(created_at, hours)
+
+
+def retry(max_attempts: int = 3, delay: float = 0.5, backoff: float = 2.0,
+          jitter: float = 0.25, exceptions: Tuple[Type[BaseException], ...] = (OSError,)):
+    """
+    Retry decorator with jittered exponential backoff
+    
+    Only `exceptions` are retried; anything else is a bug and raises at
+    once. OSError covers TimeoutError and requests.RequestException.
+    """
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            import time
-            last_exception = None
             for attempt in range(max_attempts):
                 try:
                     return func(*args, **kwargs)
-                except Exception as e:
-                    last_exception = e
-                    if attempt < max_attempts - 1:
-                        time.sleep(delay)
-            raise last_exception
+                except exceptions:
+                    if attempt == max_attempts - 1:
+                        raise
+                    pause = delay * backoff ** attempt
+                    time.sleep(pause * (1 + random.uniform(-jitter, jitter)))
         return wrapper
     return decorator
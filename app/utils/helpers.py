@@ -2,10 +2,74 @@
 KAPCI WhatsApp AI Agent - Utility Helpers
 """
 import re
+import time
 import hashlib
 from datetime import datetime, timedelta
-from typing import Optional, Dict, Any
+from typing import Optional, Any, Iterable, List, Tuple
 import json
+from bisect import bisect_right
+from collections import OrderedDict
+
+# Patterns compiled once at import
+_NON_DIGITS = re.compile(r'\D')
+_ARABIC = re.compile(r'[\u0600-\u06FF]')
+
+# parse_date: one named branch per accepted format. strptime lets %d take a
+# leading space and a space in the format match any run of whitespace.
+_DATE_SHAPES = re.compile(
+    r'^(?:(?P<ymd_dash>\d{4}-\d{1,2}- ?\d{1,2})'
+    r'|(?P<dmy_dash> ?\d{1,2}-\d{1,2}-\d{4})'
+    r'|(?P<dmy_slash> ?\d{1,2}/\d{1,2}/\d{4})'
+    r'|(?P<ymd_slash>\d{4}/\d{1,2}/ ?\d{1,2})'
+    r'|(?P<day_month>\s*\d{1,2}\s+[^\W\d_]+\s+\d{4})'
+    r'|(?P<month_day>[^\W\d_]+\s+\d{1,2},\s+\d{4}))$'
+)
+_DATE_FORMATS = {
+    'ymd_dash': '%Y-%m-%d',
+    'dmy_dash': '%d-%m-%Y',
+    'dmy_slash': '%d/%m/%Y',
+    'ymd_slash': '%Y/%m/%d',
+    'day_month': '%d %b %Y',
+    'month_day': '%B %d, %Y',
+}
+
+# time_ago buckets: under a minute, minutes, hours, days. Each label is
+# formatted with the elapsed time in its unit ('just now' ignores it)
+_TIME_AGO_BOUNDS = (60, 3600, 86400)
+_TIME_AGO_UNITS = (1, 60, 3600, 86400)
+_TIME_AGO_LABELS = {
+    'ar': ('الآن', 'منذ {} دقيقة', 'منذ {} ساعة', 'منذ {} يوم'),
+    'en': ('just now', '{} minutes ago', '{} hours ago', '{} days ago'),
+}
+
+# Egyptian weekend: Friday and Saturday
+_WEEKEND = (4, 5)
+
+
+def _business_day_offsets(weekday: int) -> Tuple[int, ...]:
+    """Calendar days from `weekday` to the 1st..5th following business day"""
+    offsets = []
+    day = 0
+    while len(offsets) < 5:
+        day += 1
+        if (weekday + day) % 7 not in _WEEKEND:
+            offsets.append(day)
+    return tuple(offsets)
+
+
+_BUSINESS_DAY_OFFSETS = tuple(_business_day_offsets(weekday) for weekday in range(7))
+
+# Greeting for each hour of the day: morning 5-11, afternoon 12-16, evening
+_GREETING_BY_HOUR = {
+    lang: tuple(
+        morning if 5 <= hour < 12 else afternoon if 12 <= hour < 17 else evening
+        for hour in range(24)
+    )
+    for lang, (morning, afternoon, evening) in {
+        'ar': ('صباح الخير', 'مساء الخير', 'مساء الخير'),
+        'en': ('Good morning', 'Good afternoon', 'Good evening'),
+    }.items()
+}
 
 
 def generate_hash(data: str) -> str:
@@ -13,13 +77,27 @@ def generate_hash(data: str) -> str:
     return hashlib.sha256(data.encode()).hexdigest()
 
 
+def generate_hashes(items: Iterable[str]) -> List[str]:
+    """Generate SHA256 hashes of many strings in one call"""
+    sha256 = hashlib.sha256
+    return [sha256(item.encode()).hexdigest() for item in items]
+
+
+def generate_hash_parts(*parts: bytes) -> str:
+    """Generate SHA256 hash of the concatenated parts without joining them"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part)
+    return digest.hexdigest()
+
+
 def sanitize_phone(phone: str) -> str:
     """
     Sanitize and format phone number
     Converts to E.164 format for Egypt
     """
     # Remove all non-digit characters
-    digits = re.sub(r'\D', '', phone)
+    digits = _NON_DIGITS.sub('', phone)
     
     # Handle Egyptian numbers
     if digits.startswith('20'):
@@ -48,35 +126,10 @@ def format_date(dt: datetime, lang: str = 'en') -> str:
 
 def time_ago(dt: datetime, lang: str = 'en') -> str:
     """Get human-readable time ago string"""
-    now = datetime.utcnow()
-    diff = now - dt
-    
-    seconds = diff.total_seconds()
-    
-    if lang == 'ar':
-        if seconds < 60:
-            return 'الآن'
-        elif seconds < 3600:
-            minutes = int(seconds / 60)
-            return f'منذ {minutes} دقيقة'
-        elif seconds < 86400:
-            hours = int(seconds / 3600)
-            return f'منذ {hours} ساعة'
-        else:
-            days = int(seconds / 86400)
-            return f'منذ {days} يوم'
-    else:
-        if seconds < 60:
-            return 'just now'
-        elif seconds < 3600:
-            minutes = int(seconds / 60)
-            return f'{minutes} minutes ago'
-        elif seconds < 86400:
-            hours = int(seconds / 3600)
-            return f'{hours} hours ago'
-        else:
-            days = int(seconds / 86400)
-            return f'{days} days ago'
+    seconds = (datetime.utcnow() - dt).total_seconds()
+    bucket = bisect_right(_TIME_AGO_BOUNDS, seconds)
+    label = _TIME_AGO_LABELS['ar' if lang == 'ar' else 'en'][bucket]
+    return label.format(int(seconds / _TIME_AGO_UNITS[bucket]))
 
 
 def truncate_text(text: str, max_length: int = 100, suffix: str = '...') -> str:
@@ -88,28 +141,20 @@ def truncate_text(text: str, max_length: int = 100, suffix: str = '...') -> str:
 
 def is_arabic(text: str) -> bool:
     """Check if text contains Arabic characters"""
-    arabic_pattern = re.compile(r'[\u0600-\u06FF]')
-    return bool(arabic_pattern.search(text))
+    return bool(_ARABIC.search(text))
 
 
 def parse_date(date_str: str) -> Optional[datetime]:
     """Parse date from various formats"""
-    formats = [
-        '%Y-%m-%d',
-        '%d-%m-%Y',
-        '%d/%m/%Y',
-        '%Y/%m/%d',
-        '%d %b %Y',
-        '%B %d, %Y'
-    ]
+    match = _DATE_SHAPES.match(date_str)
+    if not match:
+        return None
     
-    for fmt in formats:
-        try:
-            return datetime.strptime(date_str, fmt)
-        except ValueError:
-            continue
-    
-    return None
+    try:
+        return datetime.strptime(date_str, _DATE_FORMATS[match.lastgroup])
+    except ValueError:
+        # Right shape but not a real date (e.g. 31/02/2024, 5 Foo 2024)
+        return None
 
 
 def safe_json_loads(json_str: str, default: Any = None) -> Any:
@@ -131,65 +176,72 @@ def mask_phone(phone: str) -> str:
 
 def calculate_business_days(start_date: datetime, num_days: int) -> datetime:
     """Calculate date after business days (excluding weekends)"""
-    current_date = start_date
-    days_added = 0
+    if num_days <= 0:
+        return start_date
     
-    while days_added < num_days:
-        current_date += timedelta(days=1)
-        # Skip Friday and Saturday (Egyptian weekend)
-        if current_date.weekday() not in (4, 5):
-            days_added += 1
-    
-    return current_date
+    # Every calendar week holds exactly 5 business days; the last 1-5 come
+    # from the per-weekday offset table
+    weeks, remainder = divmod(num_days - 1, 5)
+    offset = 7 * weeks + _BUSINESS_DAY_OFFSETS[start_date.weekday()][remainder]
+    return start_date + timedelta(days=offset)
 
 
 def get_greeting_by_time(lang: str = 'ar') -> str:
     """Get appropriate greeting based on time of day"""
-    hour = datetime.now().hour
-    
-    if lang == 'ar':
-        if 5 <= hour < 12:
-            return 'صباح الخير'
-        elif 12 <= hour < 17:
-            return 'مساء الخير'
-        else:
-            return 'مساء الخير'
-    else:
-        if 5 <= hour < 12:
-            return 'Good morning'
-        elif 12 <= hour < 17:
-            return 'Good afternoon'
-        else:
-            return 'Good evening'
+    return _GREETING_BY_HOUR['ar' if lang == 'ar' else 'en'][datetime.now().hour]
 
 
 class RateLimiter:
-    """Simple in-memory rate limiter"""
+    """
+    Simple in-memory token-bucket rate limiter
     
-    def __init__(self, max_requests: int = 60, window_seconds: int = 60):
+    Each key may burst up to max_requests, refilled evenly over
+    window_seconds. Only (tokens, last refill time) is kept per key, in
+    least-recently-seen order: at most max_keys are held (the oldest is
+    evicted), and keys idle long enough to be full again are swept.
+    """
+    
+    # Sweep idle keys once every this many checks
+    SWEEP_INTERVAL = 4096
+    
+    def __init__(self, max_requests: int = 60, window_seconds: int = 60,
+                 max_keys: int = 100_000):
         self.max_requests = max_requests
         self.window_seconds = window_seconds
-        self.requests: Dict[str, list] = {}
+        self.max_keys = max_keys
+        self.refill_rate = max_requests / window_seconds  # tokens per second
+        self.requests: 'OrderedDict[str, Tuple[float, float]]' = OrderedDict()
+        self._ops = 0
     
     def is_allowed(self, key: str) -> bool:
         """Check if request is allowed"""
-        now = datetime.utcnow()
-        window_start = now - timedelta(seconds=self.window_seconds)
+        now = time.monotonic()
+        tokens, last = self.requests.get(key, (self.max_requests, now))
         
-        if key not in self.requests:
-            self.requests[key] = []
+        # Refill for the time elapsed since this key was last seen
+        tokens = min(self.max_requests, tokens + (now - last) * self.refill_rate)
+        allowed = tokens >= 1
         
-        # Remove old requests
-        self.requests[key] = [
-            req_time for req_time in self.requests[key]
-            if req_time > window_start
-        ]
+        self.requests[key] = (tokens - 1 if allowed else tokens, now)
+        self.requests.move_to_end(key)
+        if len(self.requests) > self.max_keys:
+            self.requests.popitem(last=False)
         
-        if len(self.requests[key]) >= self.max_requests:
-            return False
+        self._ops += 1
+        if self._ops % self.SWEEP_INTERVAL == 0:
+            self._sweep(now)
         
-        self.requests[key].append(now)
-        return True
+        return allowed
+    
+    def _sweep(self, now: float):
+        """Drop keys idle for a full window; a missing key means a full bucket"""
+        cutoff = now - self.window_seconds
+        # Oldest first, so stop at the first key seen within the window
+        while self.requests:
+            key, (_, last) = next(iter(self.requests.items()))
+            if last > cutoff:
+                break
+            del self.requests[key]
 
 
 # Singleton rate limiter
@@ -20,12 +20,22 @@ class Config:
         'pool_pre_ping': True,
         'pool_recycle': 300,
     }
+    # Set to 1 when the schema and seed data are managed outside the app
+    SKIP_DB_BOOTSTRAP = os.getenv('SKIP_DB_BOOTSTRAP', '0') == '1'
+    # Connect at startup rather than on the first request
+    DB_WARMUP_ON_START = True
+    
+    # Response cache for dashboard endpoints
+    CACHE_TYPE = os.getenv('CACHE_TYPE', 'SimpleCache')
+    CACHE_DEFAULT_TIMEOUT = 10
     
     # WhatsApp Business API
     WHATSAPP_API_URL = os.getenv('WHATSAPP_API_URL', 'https://graph.facebook.com/v18.0')
     WHATSAPP_PHONE_NUMBER_ID = os.getenv('WHATSAPP_PHONE_NUMBER_ID', '')
     WHATSAPP_ACCESS_TOKEN = os.getenv('WHATSAPP_ACCESS_TOKEN', '')
     WHATSAPP_VERIFY_TOKEN = os.getenv('WHATSAPP_VERIFY_TOKEN', 'kapci_verify_token')
+    # Meta app secret for X-Hub-Signature-256 checks (empty skips verification)
+    WHATSAPP_APP_SECRET = os.getenv('WHATSAPP_APP_SECRET', '')
     
     # External APIs
     CRM_API_URL = os.getenv('CRM_API_URL', 'http://localhost:8001/api')
@@ -37,19 +47,31 @@ class Config:
     INVENTORY_API_URL = os.getenv('INVENTORY_API_URL', 'http://localhost:8003/api')
     INVENTORY_API_KEY = os.getenv('INVENTORY_API_KEY', '')
     
+    # Redis cache for read-mostly external lookups (empty disables it)
+    REDIS_URL = os.getenv('REDIS_URL', '')
+    
+    # Celery broker for webhook processing (empty processes messages in-process)
+    CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL', '')
+    
     # AI/LLM Settings
     LLM_PROVIDER = os.getenv('LLM_PROVIDER', 'local')  # local, openai, ollama
     LLM_MODEL = os.getenv('LLM_MODEL', 'llama2')
     LLM_API_URL = os.getenv('LLM_API_URL', 'http://localhost:11434/api')
     OPENAI_API_KEY = os.getenv('OPENAI_API_KEY', '')
     
+    # Randomize account status for new customers (demo deployments only)
+    DEMO_MODE = os.getenv('DEMO_MODE', '0') == '1'
+    
     # Business Rules
     TECHNICAL_REVIEW_MAX_DAYS = 2
     REFUND_PROCESSING_DAYS = 5
     REPLACEMENT_DELIVERY_DAYS = 3
     
     # Notification Settings
-    ADMIN_NOTIFICATION_EMAILS = os.getenv('ADMIN_EMAILS', '').split(',')
+    # Comma-separated; blanks dropped so an unset variable gives no recipients
+    ADMIN_NOTIFICATION_EMAILS = tuple(
+        email.strip() for email in os.getenv('ADMIN_EMAILS', '').split(',') if email.strip()
+    )
     
     # File Upload
     UPLOAD_FOLDER = os.getenv('UPLOAD_FOLDER', 'uploads')
@@ -61,6 +83,7 @@ class DevelopmentConfig(Config):
     """Development configuration"""
     DEBUG = True
     SQLALCHEMY_ECHO = True
+    DEMO_MODE = True
 
 
 class ProductionConfig(Config):
@@ -75,15 +98,27 @@ class ProductionConfig(Config):
     )
 
 
+class ServerlessConfig(ProductionConfig):
+    """Serverless configuration (one request at a time per instance)"""
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_pre_ping': False,
+        'pool_size': 1,
+        'max_overflow': 0,
+        'pool_recycle': 300,
+    }
+
+
 class TestingConfig(Config):
     """Testing configuration"""
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
+    CACHE_TYPE = 'NullCache'
 
 
 config = {
     'development': DevelopmentConfig,
     'production': ProductionConfig,
+    'serverless': ServerlessConfig,
     'testing': TestingConfig,
     'default': DevelopmentConfig
 }
@@ -7,6 +7,9 @@ from app import create_app
 
 app = create_app()
 
+# Celery entry point (celery -A run.celery_app worker); None without a broker
+celery_app = app.extensions.get('celery')
+
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 5000))
     debug = os.getenv('FLASK_ENV', 'development') == 'development'
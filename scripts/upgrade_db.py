@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+KAPCI WhatsApp AI Agent - Upgrade an existing database to the current models
+
+db.create_all() only creates missing tables, so databases created by earlier
+releases keep their old columns, defaults and indexes. Run this once, with the
+app stopped, before starting the new release:
+
+    python scripts/upgrade_db.py
+
+It is safe to run again; every step checks the live schema first.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# The app's own bootstrap queries tickets, which fails until this has run
+os.environ['SKIP_DB_BOOTSTRAP'] = '1'
+
+from sqlalchemy import MetaData, inspect  # noqa: E402
+from sqlalchemy.schema import CreateTable  # noqa: E402
+
+from app import create_app  # noqa: E402
+from app.models import db  # noqa: E402
+
+
+def upgrade_compensation_cents(conn):
+    """Move tickets.compensation_amount (Numeric) into compensation_amount_cents"""
+    columns = {column['name'] for column in inspect(conn).get_columns('tickets')}
+    if 'compensation_amount_cents' not in columns:
+        conn.exec_driver_sql('ALTER TABLE tickets ADD COLUMN compensation_amount_cents BIGINT')
+        print('  tickets: added compensation_amount_cents')
+    if 'compensation_amount' in columns:
+        conn.exec_driver_sql(
+            'UPDATE tickets SET compensation_amount_cents = ROUND(compensation_amount * 100) '
+            'WHERE compensation_amount IS NOT NULL AND compensation_amount_cents IS NULL'
+        )
+        print('  tickets: copied compensation_amount into cents')
+
+
+def _missing_server_defaults(conn, table):
+    """Columns the model defaults on the server but the live table does not"""
+    live = {column['name']: column for column in inspect(conn).get_columns(table.name)}
+    return [
+        column for column in table.columns
+        if column.server_default is not None
+        and column.name in live and live[column.name]['default'] is None
+    ]
+
+
+def _rebuild_sqlite_table(conn, table):
+    """Recreate a SQLite table from its model, which can't ALTER a default"""
+    # Copy the whole schema so foreign keys in the new table still resolve
+    metadata = MetaData()
+    for other in db.metadata.sorted_tables:
+        other.to_metadata(metadata)
+    new_table = metadata.tables[table.name].to_metadata(metadata, name=f'_{table.name}_new')
+
+    live = {column['name'] for column in inspect(conn).get_columns(table.name)}
+    columns = ', '.join(column.name for column in table.columns if column.name in live)
+
+    conn.execute(CreateTable(new_table))
+    conn.exec_driver_sql(
+        f'INSERT INTO {new_table.name} ({columns}) SELECT {columns} FROM {table.name}'
+    )
+    conn.exec_driver_sql(f'DROP TABLE {table.name}')
+    conn.exec_driver_sql(f'ALTER TABLE {new_table.name} RENAME TO {table.name}')
+    for index in table.indexes:
+        index.create(conn)
+
+
+def upgrade_timestamp_defaults(conn):
+    """Give created_at/updated_at-style columns their database-side UTC default"""
+    dialect = conn.dialect.name
+    for table in db.metadata.sorted_tables:
+        if not inspect(conn).has_table(table.name):
+            continue
+        missing = _missing_server_defaults(conn, table)
+        if not missing:
+            continue
+
+        if dialect == 'sqlite':
+            _rebuild_sqlite_table(conn, table)
+        else:
+            for column in missing:
+                default = column.server_default.arg.compile(dialect=conn.dialect)
+                if dialect == 'mysql':
+                    column_type = column.type.compile(dialect=conn.dialect)
+                    conn.exec_driver_sql(
+                        f'ALTER TABLE {table.name} MODIFY COLUMN {column.name} '
+                        f'{column_type} NULL DEFAULT {default}'
+                    )
+                else:
+                    conn.exec_driver_sql(
+                        f'ALTER TABLE {table.name} ALTER COLUMN {column.name} '
+                        f'SET DEFAULT {default}'
+                    )
+        print(f"  {table.name}: UTC default on "
+              f"{', '.join(column.name for column in missing)}")
+
+
+def upgrade_indexes(conn):
+    """Create model indexes the live tables don't have yet"""
+    for table in db.metadata.sorted_tables:
+        if not inspect(conn).has_table(table.name):
+            continue
+        live = {index['name'] for index in inspect(conn).get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in live:
+                index.create(conn)
+                print(f'  {table.name}: created index {index.name}')
+
+
+def main():
+    app = create_app()
+
+    with app.app_context():
+        print(f"Upgrading {db.engine.url.render_as_string(hide_password=True)}")
+        with db.engine.begin() as conn:
+            if inspect(conn).has_table('tickets'):
+                upgrade_compensation_cents(conn)
+            upgrade_timestamp_defaults(conn)
+            upgrade_indexes(conn)
+
+        # Missing tables (e.g. ticket_counters) and seed data come from the app
+        from app import _bootstrap_database
+        _bootstrap_database(app)
+
+    print('Done.')
+
+
+if __name__ == '__main__':
+    main()
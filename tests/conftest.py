@@ -6,21 +6,30 @@ import sys
 import os
 
 # Add project root to path
-sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
 
-from app import create_app
+from app import create_app, _bootstrap_database
 from app.models import db
 
 
+@pytest.fixture(scope='session')
+def session_app():
+    """Create the application once for the whole test run"""
+    return create_app('testing')
+
+
 @pytest.fixture
-def app():
-    """Create application for testing"""
-    app = create_app('testing')
-    
-    with app.app_context():
-        db.create_all()
-        yield app
+def app(session_app):
+    """Application with a fresh app context and freshly seeded database per test"""
+    with session_app.app_context():
+        yield session_app
+        db.session.remove()
         db.drop_all()
+    
+    # Recreate tables and seed data for the next test
+    _bootstrap_database(session_app)
 
 
 @pytest.fixture
@@ -2,15 +2,22 @@
 KAPCI WhatsApp AI Agent - Service Tests
 """
 import pytest
+import re
+from datetime import datetime
+from app.models import Ticket
 from app.services.ai_service import AIService
+from app.utils import parse_date
+from app.utils.helpers import RateLimiter
+from app.services.external_apis import CircuitBreakerAdapter, CircuitOpenError
 
 
 class TestAIService:
     """Test AI Service"""
     
-    def setup_method(self):
-        """Setup test instance"""
-        self.ai = AIService()
+    @pytest.fixture(scope='class', autouse=True)
+    def _ai(self, request):
+        """Share one AIService across the class"""
+        request.cls.ai = AIService()
     
     def test_classify_greeting_english(self):
         """Test greeting classification in English"""
@@ -24,6 +31,12 @@ class TestAIService:
         assert self.ai.classify_intent('السلام عليكم', 'idle') == 'greeting'
         assert self.ai.classify_intent('اهلا', 'idle') == 'greeting'
     
+    def test_classify_normalized_arabic(self):
+        """Test classification ignores tatweel, diacritics and presentation forms"""
+        assert self.ai.classify_intent('مـرحـبـا', 'idle') == 'greeting'
+        assert self.ai.classify_intent('شَكْوَى', 'idle') == 'new_complaint'
+        assert self.ai.classify_intent('ﻣﺮﺣﺒﺎ', 'idle') == 'greeting'
+    
     def test_classify_new_complaint(self):
         """Test new complaint classification"""
         assert self.ai.classify_intent('1', 'idle') == 'new_complaint'
@@ -54,6 +67,18 @@ class TestAIService:
         assert self.ai.classify_intent('some product', 'collecting_product') == 'provide_info'
         assert self.ai.classify_intent('the paint is bad', 'collecting_issue') == 'provide_info'
     
+    def test_analyze(self):
+        """Test combined language, intent and entity analysis"""
+        result = self.ai.analyze('hello, my email is ali@kapci.com', 'idle')
+        assert result['language'] == 'en'
+        assert result['intent'] == 'greeting'
+        assert result['entities']['email'] == 'ali@kapci.com'
+        
+        # Repeats come from the cache but are independent copies
+        result['entities'].clear()
+        again = self.ai.analyze('hello, my email is ali@kapci.com', 'idle')
+        assert again['entities']['email'] == 'ali@kapci.com'
+    
     def test_detect_language_arabic(self):
         """Test Arabic language detection"""
         assert self.ai.detect_language('مرحبا كيف حالك') == 'ar'
@@ -69,8 +94,236 @@ class TestAIService:
         entities = self.ai.extract_entities('My ticket is TKT-2024-12345')
         assert entities.get('ticket_number') == 'TKT-2024-12345'
     
+    def test_extract_multiple_entities(self):
+        """Test extracting several entities from one message"""
+        entities = self.ai.extract_entities(
+            'TKT-2024-12345 call 01012345678 on 12/5/2024 QTY: 3 mail a.b@x.com'
+        )
+        assert entities == {
+            'ticket_number': 'TKT-2024-12345',
+            'phone': '01012345678',
+            'date': '12/5/2024',
+            'quantity': 3,
+            'email': 'a.b@x.com'
+        }
+    
+    def test_extract_overlapping_entities(self):
+        """Test entities sharing the same text are each extracted"""
+        entities = self.ai.extract_entities('my email 01012345678@gmail.com')
+        assert entities['email'] == '01012345678@gmail.com'
+        assert entities['phone'] == '01012345678'
+        
+        entities = self.ai.extract_entities('qty 01012345678')
+        assert entities['quantity'] == 1012345678
+        assert entities['phone'] == '01012345678'
+    
     def test_suggest_issue_category(self):
         """Test issue category suggestion"""
         assert self.ai.suggest_issue_category('product is broken') == 'quality'
         assert self.ai.suggest_issue_category('wrong product delivered') == 'wrong_product'
         assert self.ai.suggest_issue_category('parts are missing') == 'missing_parts'
+
+
+class TestTicketModel:
+    """Test Ticket model helpers"""
+    
+    def test_generate_ticket_number(self):
+        """Test ticket number format"""
+        ticket_number = Ticket.generate_ticket_number()
+        assert re.match(r'^TKT-\d{4}-\d{5}$', ticket_number)
+
+
+class TestTicketService:
+    """Test Ticket Service"""
+    
+    def test_update_ticket_ignores_unknown_fields(self, app):
+        """Test update_ticket writes whitelisted columns only"""
+        from app.models import db, Customer
+        from app.services.ticket_service import ticket_service
+        
+        customer = Customer(phone_number='+201000000001')
+        db.session.add(customer)
+        db.session.commit()
+        ticket = ticket_service.create_ticket(customer.id, {'product_name': 'Cable'})
+        
+        updated = ticket_service.update_ticket(ticket.id, {
+            'product_name': 'Cable 2mm',
+            'ticket_number': 'TKT-0000-00000',
+            'customer_id': 999
+        })
+        
+        assert updated.product_name == 'Cable 2mm'
+        assert updated.ticket_number == ticket.ticket_number
+        assert updated.customer_id == customer.id
+        assert ticket_service.update_ticket(999, {'priority': 'high'}) is None
+    
+    def test_create_ticket_is_one_transaction(self, app, monkeypatch):
+        """Test a failure after the ticket insert rolls the ticket back too"""
+        from app.models import db, Customer, Ticket
+        from app.services.ticket_service import ticket_service
+        
+        customer = Customer(phone_number='+201000000002')
+        db.session.add(customer)
+        db.session.commit()
+        
+        def fail(*args, **kwargs):
+            raise RuntimeError('assignment failed')
+        monkeypatch.setattr(ticket_service, '_record_assignment', fail)
+        
+        with pytest.raises(RuntimeError):
+            ticket_service.create_ticket(customer.id, {'product_name': 'Cable'})
+        db.session.rollback()
+        
+        assert db.session.query(Ticket).count() == 0
+    
+    def test_history_survives_savepoint_rollback(self, app):
+        """Test a failed savepoint keeps the outer transaction's queued history"""
+        from sqlalchemy.exc import IntegrityError
+        from app.models import db, Customer, TicketStatusHistory
+        from app.services.ticket_service import ticket_service
+        
+        customer = Customer(phone_number='+201000000004')
+        db.session.add(customer)
+        db.session.commit()
+        ticket = ticket_service.create_ticket(customer.id, {'product_name': 'Cable'})
+        before = db.session.query(TicketStatusHistory).count()
+        
+        ticket_service._log_status_change(ticket.id, 'a', 'b', 'test')
+        with pytest.raises(IntegrityError):
+            with db.session.begin_nested():
+                db.session.add(Customer(phone_number='+201000000004'))
+        ticket_service._commit()
+        
+        assert db.session.query(TicketStatusHistory).count() == before + 1
+    
+    def test_timestamps_are_utc(self, app):
+        """Test database-side created_at defaults use the same UTC clock as Python"""
+        from app.models import db, Customer
+        
+        before = datetime.utcnow().replace(microsecond=0)
+        customer = Customer(phone_number='+201000000005')
+        db.session.add(customer)
+        db.session.commit()
+        
+        assert before <= customer.created_at <= datetime.utcnow()
+    
+    def test_statistics_follow_ticket_changes(self, app):
+        """Test counter-backed statistics match a full recount"""
+        from app.models import db, Customer, TicketStatus
+        from app.services.ticket_service import ticket_service
+        
+        customer = Customer(phone_number='+201000000002')
+        db.session.add(customer)
+        db.session.commit()
+        first = ticket_service.create_ticket(customer.id, {'product_name': 'Cable'})
+        second = ticket_service.create_ticket(customer.id, {'product_name': 'Switch'})
+        ticket_service.record_technical_decision(first.id, 'approved', 'ok')
+        ticket_service.update_status(second.id, TicketStatus.COMPLETED)
+        
+        stats = ticket_service.get_statistics()
+        assert stats['total'] == 2
+        assert stats['approved'] == 1
+        assert stats['completed'] == 1
+        assert stats['pending'] == 0
+        
+        ticket_service.rebuild_counters()
+        assert ticket_service.get_statistics() == stats
+    
+    def test_counter_rows_are_seeded(self, app):
+        """Test every known counter key exists up front, so ticket writes only UPDATE"""
+        from app.models import db, Customer, TicketCounter
+        from app.services.ticket_service import ticket_service
+        
+        keys = set(db.session.scalars(db.select(TicketCounter.key)))
+        assert keys == set(TicketCounter.all_keys())
+        
+        customer = Customer(phone_number='+201000000003')
+        db.session.add(customer)
+        db.session.commit()
+        ticket_service.create_ticket(customer.id, {'product_name': 'Cable'})
+        
+        assert db.session.query(TicketCounter).count() == len(keys)
+
+
+class TestParseDate:
+    """Test date parsing in app.utils"""
+    
+    def test_accepted_shapes(self):
+        """Test year-first and year-last dates, including a space-padded day"""
+        expected = datetime(2024, 1, 5)
+        for value in ('2024-01-05', '5-1-2024', '05/01/2024', '2024/1/5',
+                      ' 5-1-2024', '2024-1- 5', '2024/01/ 5'):
+            assert parse_date(value) == expected, value
+    
+    def test_rejected_shapes(self):
+        """Test malformed or impossible dates return None"""
+        for value in ('2024-01/05', ' 15-1-2024', '2024-1-5\n', '31/02/2024', ''):
+            assert parse_date(value) is None, value
+
+
+class TestRateLimiter:
+    """Test the token-bucket rate limiter"""
+    
+    def test_burst_then_refill(self, monkeypatch):
+        """Test a key is limited after its burst and refills over time"""
+        now = [1000.0]
+        monkeypatch.setattr('app.utils.helpers.time.monotonic', lambda: now[0])
+        limiter = RateLimiter(max_requests=3, window_seconds=60)
+        
+        assert [limiter.is_allowed('a') for _ in range(4)] == [True, True, True, False]
+        assert limiter.is_allowed('b')
+        
+        # One token comes back every 20 seconds
+        now[0] += 20
+        assert limiter.is_allowed('a')
+        assert not limiter.is_allowed('a')
+    
+    def test_key_map_is_bounded(self):
+        """Test the least recently seen key is evicted past max_keys"""
+        limiter = RateLimiter(max_requests=1, window_seconds=60, max_keys=2)
+        
+        for key in ('a', 'b', 'a', 'c'):
+            limiter.is_allowed(key)
+        
+        assert list(limiter.requests) == ['a', 'c']
+
+
+class TestCircuitBreaker:
+    """Test the circuit breaker on backend sessions"""
+    
+    def test_opens_on_exhausted_retries_and_probes_once(self, monkeypatch):
+        """Test 5xx retry exhaustion trips the breaker and half-open admits one probe"""
+        import requests
+        from requests.adapters import HTTPAdapter
+        
+        now = [1000.0]
+        monkeypatch.setattr('app.services.external_apis.time.monotonic', lambda: now[0])
+        adapter = CircuitBreakerAdapter(fail_max=3, reset_timeout=30)
+        request = requests.Request('GET', 'http://crm.local/customers').prepare()
+        
+        def exhausted(self, request, **kwargs):
+            raise requests.exceptions.RetryError('too many 503 error responses')
+        monkeypatch.setattr(HTTPAdapter, 'send', exhausted)
+        
+        for _ in range(3):
+            with pytest.raises(requests.exceptions.RetryError):
+                adapter.send(request)
+        with pytest.raises(CircuitOpenError):
+            adapter.send(request)
+        
+        # After the reset timeout only the probe reaches the backend
+        now[0] += 30
+        concurrent = []
+        
+        def probe(self, request, **kwargs):
+            with pytest.raises(CircuitOpenError):
+                adapter.send(request)
+            concurrent.append(True)
+            response = requests.Response()
+            response.status_code = 200
+            return response
+        monkeypatch.setattr(HTTPAdapter, 'send', probe)
+        
+        assert adapter.send(request).status_code == 200
+        assert concurrent == [True]
+        assert adapter._opened_at is None and adapter._failures == 0